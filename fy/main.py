@@ -1,23 +1,448 @@
 from pagermaid.listener import listener
 from pagermaid.enums import Message
+from pagermaid.hook import Hook
+from pyrogram.errors import FloodWait
 import os
+import re
 import json
+import time
+import sqlite3
 import asyncio
+import threading
 import aiohttp
+from collections import OrderedDict
 
 # 全局变量
 from_lang = "auto"  # 源语言，固定为 auto
 to_lang = "en"      # 默认目标语言为英语
 global_translate_enabled = False  # 全局翻译开关
+batch_translate_enabled = False   # 合并短时间内的多条消息为一次翻译请求
+
+DEEPLX_URL = "https://api.deeplx.org/EaEyeqJu9r6Or7Mpz4ufO2pPYc3MEkqtNN5G2LG1A8k/translate"  # 默认翻译接口
+
+# HTTP 连接设置
+HTTP_LIMIT = 10           # 连接池最大连接数
+HTTP_LIMIT_PER_HOST = 5   # 单个主机最大连接数
+HTTP_TIMEOUT = 15         # 单次请求总超时（秒）
+HTTP_KEEPALIVE = 60       # 空闲连接保持时间（秒）
+
+_session = None  # 共享的 aiohttp.ClientSession，首次使用时创建
+
+# 多接口路由设置
+EWMA_ALPHA = 0.3          # 延迟指数加权平均的新样本权重
+BREAKER_THRESHOLD = 3     # 连续失败多少次后熔断
+BREAKER_COOLDOWN = 60     # 熔断后多久允许再次尝试（秒）
+HEDGE_FACTOR = 2.0        # 首选接口超过其平均延迟的多少倍仍未返回时，向下一个接口发出对冲请求
+HEDGE_MIN = 0.3           # 对冲等待时间下限（秒）
+HEDGE_DEFAULT = 1.5       # 首选接口尚无延迟数据时的对冲等待时间（秒）
+HEALTH_INTERVAL = 120     # 后台健康检查间隔（秒）
+
+class DeepLXBackend:
+    """单个 DeepLX 兼容接口，记录 EWMA 延迟并维护熔断状态"""
+
+    def __init__(self, url):
+        self.url = url
+        self.latency = None       # EWMA 延迟（秒），尚无成功请求时为 None
+        self.failures = 0         # 连续失败次数
+        self.open_until = 0.0     # 熔断结束时间（time.monotonic）
+
+    @property
+    def available(self):
+        return time.monotonic() >= self.open_until
+
+    def record_latency(self, elapsed):
+        self.latency = elapsed if self.latency is None else EWMA_ALPHA * elapsed + (1 - EWMA_ALPHA) * self.latency
+
+    def record_success(self, elapsed):
+        self.record_latency(elapsed)
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= BREAKER_THRESHOLD:
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+
+    async def translate(self, payload):
+        """
+        请求该接口翻译，失败时记录并返回 None。被取消（对冲请求落败）时不计入失败，
+        但已等待的时间是真实延迟的下限，超过当前平均延迟时计入 EWMA，使变慢的接口让出首选位置。
+        """
+        start = time.monotonic()
+        try:
+            async with get_session().post(self.url, json=payload) as response:
+                if response.status != 200:
+                    print(f"翻译失败：{self.url} HTTP {response.status}")
+                    self.record_failure()
+                    return None
+
+                result = await response.json()
+                if result.get("code") != 200:
+                    print(f"翻译失败：{self.url} {result}")
+                    self.record_failure()
+                    return None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print(f"翻译失败：{self.url} {e}")
+            self.record_failure()
+            return None
+        except asyncio.CancelledError:
+            elapsed = time.monotonic() - start
+            if self.latency is None or elapsed > self.latency:
+                self.record_latency(elapsed)
+            raise
+
+        self.record_success(time.monotonic() - start)
+        return result.get("data")
+
+    def status(self):
+        latency = f"{self.latency * 1000:.0f} ms" if self.latency is not None else "未知"
+        state = "可用" if self.available else "熔断中"
+        return f"{self.url} | {state} | 延迟 {latency} | 连续失败 {self.failures}"
+
+backends = [DeepLXBackend(DEEPLX_URL)]
+_health_task = None
+
+def set_endpoints(urls):
+    """更新接口列表，保留已有接口的延迟和熔断状态"""
+    global backends
+    existing = {backend.url: backend for backend in backends}
+    backends = [existing.get(url) or DeepLXBackend(url) for url in dict.fromkeys(urls)] or [DeepLXBackend(DEEPLX_URL)]
+
+def ranked_backends():
+    """可用接口按 EWMA 延迟从低到高排序（尚无数据的排在最前以便探测），全部熔断时按恢复时间排序"""
+    available = [backend for backend in backends if backend.available]
+    if not available:
+        return sorted(backends, key=lambda backend: backend.open_until)
+    return sorted(available, key=lambda backend: backend.latency or 0.0)
+
+async def health_check_loop():
+    """定期用短文本探测所有接口，更新延迟并让恢复的接口尽快退出熔断"""
+    while True:
+        await asyncio.sleep(HEALTH_INTERVAL)
+        payload = {"text": "hello", "source_lang": "auto", "target_lang": "en"}
+        await asyncio.gather(*(backend.translate(payload) for backend in backends))
+
+def ensure_health_check():
+    global _health_task
+    if len(backends) > 1 and (_health_task is None or _health_task.done()):
+        _health_task = asyncio.create_task(health_check_loop())
+
+# 翻译设置，启动时从 fy.json 读取一次，之后在内存中维护
+SETTINGS_FILE = "fy.json"
+SAVE_DELAY = 2            # 设置变更后延迟写入（秒），合并短时间内的多次修改
+RELOAD_INTERVAL = 5       # 检查 fy.json 是否被外部修改的最小间隔（秒）
+
+DEFAULT_PREFIXES = ("，", ",", "/", "-")  # 以这些前缀开头的消息不翻译
+DEFAULT_CHAT_SETTINGS = {"enabled": False, "lang": None, "prefixes": DEFAULT_PREFIXES}
+chat_settings = {}        # chat_id -> {"enabled": 是否开启, "lang": 目标语言（None 时使用全局）, "prefixes": 不翻译的前缀}
+_settings_mtime = None    # 最近一次读取或写入时 fy.json 的修改时间
+_last_reload_check = 0.0
+_save_task = None
+
+def load_settings():
+    """从 fy.json 读取设置到内存，文件修改时间未变化时跳过"""
+    global chat_settings, to_lang, batch_translate_enabled, _settings_mtime
+    try:
+        mtime = os.stat(SETTINGS_FILE).st_mtime
+        if mtime == _settings_mtime:
+            return
+        with open(SETTINGS_FILE, "r", encoding="utf-8") as file:
+            data = json.load(file)
+    except (OSError, json.JSONDecodeError):
+        return
+    _settings_mtime = mtime
+    if "chats" in data:
+        chat_settings = {int(chat_id): {"enabled": item.get("enabled", False), "lang": item.get("lang"),
+                                        "prefixes": tuple(item.get("prefixes", DEFAULT_PREFIXES))}
+                         for chat_id, item in data["chats"].items()}
+    else:  # 兼容旧版只保存 translate_id 列表的配置
+        chat_settings = {int(chat_id): dict(DEFAULT_CHAT_SETTINGS, enabled=True)
+                         for chat_id in data.get("translate_id", [])}
+    to_lang = data.get("to_lang", to_lang)
+    batch_translate_enabled = data.get("batch", batch_translate_enabled)
+    set_endpoints(data.get("endpoints", [DEEPLX_URL]))
+
+def reload_settings_if_changed():
+    """限制检查频率，fy.json 被外部修改时重新读取"""
+    global _last_reload_check
+    now = time.monotonic()
+    if now - _last_reload_check >= RELOAD_INTERVAL:
+        _last_reload_check = now
+        load_settings()
+
+def save_settings():
+    """先写临时文件再替换，保证 fy.json 不会被写坏"""
+    global _settings_mtime
+    chats = {str(chat_id): {"enabled": item["enabled"], "lang": item["lang"], "prefixes": list(item["prefixes"])}
+             for chat_id, item in chat_settings.items()}
+    data = {"chats": chats, "from_lang": from_lang, "to_lang": to_lang,
+            "batch": batch_translate_enabled, "endpoints": [backend.url for backend in backends]}
+    temp_path = f"{SETTINGS_FILE}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file, indent=4, ensure_ascii=False)
+    os.replace(temp_path, SETTINGS_FILE)
+    _settings_mtime = os.stat(SETTINGS_FILE).st_mtime
+
+async def _delayed_save():
+    await asyncio.sleep(SAVE_DELAY)
+    try:
+        save_settings()
+    except OSError as e:
+        print(f"保存翻译设置失败：{e}")
+
+def get_chat_settings(chat_id):
+    """返回聊天设置，不存在时返回只读的默认设置"""
+    return chat_settings.get(chat_id, DEFAULT_CHAT_SETTINGS)
+
+def update_chat_settings(chat_id, **changes):
+    """修改聊天设置并写回，恢复为默认值的聊天从表中移除"""
+    settings = dict(get_chat_settings(chat_id), **changes)
+    if settings == DEFAULT_CHAT_SETTINGS:
+        chat_settings.pop(chat_id, None)
+    else:
+        chat_settings[chat_id] = settings
+    schedule_save()
+    return settings
+
+def schedule_save():
+    """防抖写入：已有待写入任务时不重复创建，任务执行时写入最新的内存状态"""
+    global _save_task
+    if _save_task is None or _save_task.done():
+        _save_task = asyncio.create_task(_delayed_save())
+
+load_settings()
+
+# 翻译缓存设置
+CACHE_FILE = "data/fy_cache.db"
+CACHE_MEMORY_ITEMS = 512        # 内存中缓存的翻译条数
+CACHE_DISK_ITEMS = 20000        # sqlite 中最多保存的翻译条数
+CACHE_TTL = 7 * 24 * 3600       # 缓存有效期（秒）
+CACHE_MAX_TEXT = 1000           # 超过该长度的文本不缓存
+
+class TranslationCache:
+    """翻译缓存：内存 LRU + sqlite 持久化，按 (原文, 源语言, 目标语言) 索引"""
+
+    def __init__(self, path, memory_items, disk_items, ttl):
+        self.path = path
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self.ttl = ttl
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # key -> (写入时间, 译文)
+        self._db = None
+        self._lock = threading.Lock()  # sqlite 操作在线程池中执行，串行访问连接
+        self._writes = 0
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS translations ("
+                "text TEXT, source_lang TEXT, target_lang TEXT, result TEXT, created_at REAL, used_at REAL, "
+                "PRIMARY KEY (text, source_lang, target_lang))")
+            self._db.execute("CREATE INDEX IF NOT EXISTS translations_used_at ON translations (used_at)")
+        return self._db
+
+    def _disk_get(self, key):
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            row = db.execute(
+                "SELECT result, created_at FROM translations WHERE text = ? AND source_lang = ? AND target_lang = ? "
+                "AND created_at > ?", (*key, now - self.ttl)).fetchone()
+            if row:
+                db.execute("UPDATE translations SET used_at = ? WHERE text = ? AND source_lang = ? AND target_lang = ?",
+                           (now, *key))
+                db.commit()
+        return row
+
+    def _disk_set(self, key, result, created_at):
+        with self._lock:
+            db = self._connect()
+            db.execute("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?, ?)",
+                       (*key, result, created_at, created_at))
+            self._writes += 1
+            # 每写入 100 条清理一次过期和超出数量上限的记录
+            if self._writes % 100 == 0:
+                db.execute("DELETE FROM translations WHERE created_at <= ?", (created_at - self.ttl,))
+                db.execute("DELETE FROM translations WHERE rowid IN (SELECT rowid FROM translations "
+                           "ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (self.disk_items,))
+            db.commit()
+
+    def _remember(self, key, created_at, result):
+        self._memory[key] = (created_at, result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    async def get(self, text, source_lang, target_lang):
+        key = (text, source_lang, target_lang)
+        item = self._memory.get(key)
+        if item and time.time() - item[0] < self.ttl:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+        try:
+            row = await asyncio.to_thread(self._disk_get, key)
+        except sqlite3.Error as e:
+            print(f"读取翻译缓存失败：{e}")
+            row = None
+        if row:
+            self._remember(key, row[1], row[0])
+            self.hits += 1
+            self.disk_hits += 1
+            return row[0]
+
+        self.misses += 1
+        return None
+
+    async def set(self, text, source_lang, target_lang, result):
+        if len(text) > CACHE_MAX_TEXT:
+            return
+        key = (text, source_lang, target_lang)
+        now = time.time()
+        self._remember(key, now, result)
+        try:
+            await asyncio.to_thread(self._disk_set, key, result, now)
+        except sqlite3.Error as e:
+            print(f"写入翻译缓存失败：{e}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0
+        return (f"翻译缓存：命中 {self.hits}（磁盘 {self.disk_hits}） / 未命中 {self.misses}，"
+                f"命中率 {hit_rate:.1f}%，内存条目 {len(self._memory)}")
+
+translation_cache = TranslationCache(CACHE_FILE, CACHE_MEMORY_ITEMS, CACHE_DISK_ITEMS, CACHE_TTL)
+
+# 翻译队列设置
+API_CONCURRENCY = 4       # 同时进行的翻译请求上限
+EDIT_RATE = 1.0           # message.edit 令牌桶每秒补充的令牌数
+EDIT_BURST = 3            # 令牌桶容量，即允许的突发编辑次数
+EDIT_RETRIES = 3          # 编辑遇到 FloodWait 时的最大重试次数
+WORKER_IDLE_TIMEOUT = 60  # 聊天队列空闲多久后结束对应的 worker（秒）
+
+class TokenBucket:
+    """令牌桶限速器，acquire 在令牌不足时等待补充"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+api_semaphore = asyncio.Semaphore(API_CONCURRENCY)
+edit_bucket = TokenBucket(EDIT_RATE, EDIT_BURST)
+_chat_queues = {}   # chat_id -> asyncio.Queue，保证同一聊天内按发送顺序翻译
+_chat_workers = {}  # chat_id -> 处理该队列的 asyncio.Task
+
+# 批量翻译设置
+BATCH_WINDOW = 0.8        # 收到消息后等待同一聊天后续消息的时间（秒）
+BATCH_MAX = 10            # 单次请求合并的最大消息数
+# 合并时用编号标记分隔各条消息，译文按标记拆回；包含标记字符的消息单独翻译
+BATCH_MARKER = "§§{}§§"
+BATCH_SPLIT = re.compile(r"\s*§§\s*(\d+)\s*§§\s*")
+
+# 本地语言预判：跳过已是目标语言或没有可翻译内容的消息，省去一次接口请求和消息编辑
+NON_TRANSLATABLE = re.compile(r"https?://\S+|www\.\S+|@\w+|#\w+|\S+@\S+\.\w+|[\d\W_]+")
+SCRIPT_RANGES = [  # (起始码位, 结束码位, 文字)
+    (0x0041, 0x024F, "latin"),
+    (0x0370, 0x03FF, "greek"),
+    (0x0400, 0x04FF, "cyrillic"),
+    (0x0590, 0x05FF, "hebrew"),
+    (0x0600, 0x06FF, "arabic"),
+    (0x0E00, 0x0E7F, "thai"),
+    (0x1100, 0x11FF, "hangul"),
+    (0x3040, 0x30FF, "kana"),
+    (0x3400, 0x9FFF, "han"),
+    (0xAC00, 0xD7AF, "hangul"),
+    (0xF900, 0xFAFF, "han"),
+]
+# 目标语言 -> 只被该语言使用、可据文字直接判断的文字集合；
+# 西里尔、阿拉伯等多语言共用的文字无法区分具体语言，一律交给接口翻译
+LANG_SCRIPTS = {
+    "zh": {"han"}, "ja": {"kana", "han"}, "ko": {"hangul"},
+    "el": {"greek"}, "he": {"hebrew"}, "th": {"thai"},
+}
+TRADITIONAL_TARGETS = {"zh-tw", "zh-hk", "zh-hant"}  # 繁体目标无法可靠区分简繁，一律翻译
+# 常见的繁体专用字，出现时说明文本不是简体中文
+TRADITIONAL_CHARS = set("們個這說時會來對將過為後從還與學國門間開關見長東車馬語話讀書體點頭無愛經實現發記問題")
+# 拉丁文字语言靠高频功能词区分，命中目标语言的词数需明显多于其他语言
+LATIN_STOPWORDS = {
+    "en": {"the", "and", "is", "are", "was", "to", "of", "in", "it", "you", "that", "this", "for", "with", "not", "have", "what", "i"},
+    "de": {"der", "die", "das", "und", "ist", "nicht", "ich", "du", "mit", "ein", "eine", "zu", "auf", "es", "sie", "wir"},
+    "fr": {"le", "la", "les", "et", "est", "je", "tu", "pas", "une", "un", "des", "que", "pour", "dans", "avec", "ce"},
+    "es": {"el", "la", "los", "las", "y", "es", "que", "de", "no", "un", "una", "por", "con", "para", "yo", "está"},
+    "it": {"il", "lo", "la", "gli", "e", "è", "che", "di", "non", "un", "una", "per", "con", "sono", "io", "questo"},
+    "pt": {"o", "a", "os", "as", "e", "é", "que", "de", "não", "um", "uma", "para", "com", "eu", "você", "isso"},
+    "nl": {"de", "het", "een", "en", "is", "niet", "ik", "je", "van", "dat", "op", "met", "zijn", "voor", "wat"},
+}
+WORD_PATTERN = re.compile(r"[^\W\d_]+")
+prefilter_skipped = 0     # 被本地预判跳过的消息数
+
+def char_script(char):
+    code = ord(char)
+    for start, end, script in SCRIPT_RANGES:
+        if start <= code <= end:
+            return script
+    return None
+
+def needs_translation(text, target_lang):
+    """粗略判断文本是否需要翻译：去掉链接、提及、数字、符号和表情后无内容，或主体已是目标语言时返回 False"""
+    letters = NON_TRANSLATABLE.sub("", text)
+    if not letters:
+        return False
+
+    counts = {}
+    for char in letters:
+        script = char_script(char)
+        if script:
+            counts[script] = counts.get(script, 0) + 1
+    if not counts:
+        return True  # 有文字但不属于已知文字（天城文、格鲁吉亚文等），交给接口判断
+
+    lang_tag = target_lang.lower()
+    target = lang_tag.split("-")[0]
+    total = sum(counts.values())
+    scripts = LANG_SCRIPTS.get(target)
+    if scripts:
+        if target == "zh":
+            if lang_tag in TRADITIONAL_TARGETS or counts.get("kana") or not TRADITIONAL_CHARS.isdisjoint(letters):
+                return True  # 繁体目标、含假名（日语）或含繁体字时交给接口
+        elif target == "ja" and not counts.get("kana"):
+            return True  # 只有汉字时多半是中文，不能视为日语
+        return sum(counts.get(script, 0) for script in scripts) / total < 0.8
+
+    if target not in LATIN_STOPWORDS or counts.get("latin", 0) / total < 0.8:
+        return True
+    words = [word.lower() for word in WORD_PATTERN.findall(text)]
+    hits = {lang: sum(word in stopwords for word in words) for lang, stopwords in LATIN_STOPWORDS.items()}
+    best_other = max(hit for lang, hit in hits.items() if lang != target)
+    return not (hits[target] >= 2 and hits[target] > best_other)
 
 @listener(command="fy",
           description="控制翻译功能",
-          parameters="[无参数] 开关当前聊天翻译 | all on/off 开启或关闭全局翻译 | set <目标语言> 设置目标语言",
+          parameters="[无参数] 开关当前聊天翻译 | all on/off 开启或关闭全局翻译 | set <目标语言> 设置全局目标语言 | lang [目标语言] 设置当前聊天目标语言 | prefix [add/del <前缀>] 当前聊天不翻译的前缀 | batch on/off 合并连续消息批量翻译 | api [add/del <地址>] 管理翻译接口 | stats 翻译缓存统计",
           prefix=",")
 async def handle_fy_command(message: Message):
     chat_id = message.chat.id
     args = message.parameter
-    file_path = "fy.json"
 
     # 处理全局翻译开关
     if len(args) == 2 and args[0] == "all" and args[1] in ["on", "off"]:
@@ -29,70 +454,75 @@ async def handle_fy_command(message: Message):
         await message.delete()
         return  # 优先处理全局翻译，退出函数
 
+    # 处理批量翻译开关
+    if len(args) == 2 and args[0] == "batch" and args[1] in ["on", "off"]:
+        global batch_translate_enabled
+        batch_translate_enabled = args[1] == "on"
+        schedule_save()
+        status = "开启" if batch_translate_enabled else "关闭"
+        await message.edit(f"批量翻译已{status}。")
+        await asyncio.sleep(5)
+        await message.delete()
+        return
+
+    # 处理翻译接口管理
+    if args and args[0] == "api":
+        if len(args) == 3 and args[1] in ["add", "del"]:
+            urls = [backend.url for backend in backends]
+            if args[1] == "add" and args[2] not in urls:
+                urls.append(args[2])
+            elif args[1] == "del" and args[2] in urls:
+                urls.remove(args[2])
+            set_endpoints(urls)
+            schedule_save()
+        await message.edit("翻译接口：\n" + "\n".join(backend.status() for backend in ranked_backends()))
+        return
+
     # 处理语言设置
     if len(args) == 2 and args[0] == "set":
         global to_lang
         new_to_lang = args[1]
-        try:
-            try:
-                with open(file_path, "r", encoding="utf-8") as file:
-                    settings = json.load(file)
-            except (FileNotFoundError, json.JSONDecodeError):
-                settings = {"translate_id": []}
-            settings["from_lang"] = from_lang  # 固定为 auto
-            settings["to_lang"] = new_to_lang
-            with open(file_path, "w", encoding="utf-8") as file:
-                json.dump(settings, file, indent=4, ensure_ascii=False)
-            to_lang = new_to_lang
-            await message.edit(f"翻译语言设置为：从 {from_lang} 到 {new_to_lang}")
-            await asyncio.sleep(5)
-            await message.delete()
-        except Exception as e:
-            await message.edit(f"保存设置时发生错误：{e}")
-            await asyncio.sleep(5)
-            await message.delete()
+        to_lang = new_to_lang
+        schedule_save()
+        await message.edit(f"翻译语言设置为：从 {from_lang} 到 {new_to_lang}")
+        await asyncio.sleep(5)
+        await message.delete()
+        return
+
+    # 处理当前聊天的目标语言和前缀排除
+    if args and args[0] == "lang":
+        settings = update_chat_settings(chat_id, lang=args[1] if len(args) > 1 else None)
+        await message.edit(f"此聊天翻译语言：从 {from_lang} 到 {settings['lang'] or to_lang}"
+                           f"{'' if settings['lang'] else '（跟随全局）'}")
+        await asyncio.sleep(5)
+        await message.delete()
+        return
+    if args and args[0] == "prefix":
+        prefixes = get_chat_settings(chat_id)["prefixes"]
+        if len(args) == 3 and args[1] == "add" and args[2] not in prefixes:
+            prefixes = update_chat_settings(chat_id, prefixes=prefixes + (args[2],))["prefixes"]
+        elif len(args) == 3 and args[1] == "del" and args[2] in prefixes:
+            prefixes = update_chat_settings(chat_id, prefixes=tuple(p for p in prefixes if p != args[2]))["prefixes"]
+        await message.edit("此聊天不翻译的前缀：" + " ".join(f"<code>{p}</code>" for p in prefixes))
         return
 
     # 处理独立翻译开关
     if not args:  # 无参数时切换当前聊天翻译
-        if not os.path.exists(file_path):
-            data = {"translate_id": []}
-        else:
-            with open(file_path, "r", encoding="utf-8") as file:
-                data = json.load(file)
-
-        translate_ids = data.get("translate_id", [])
-
-        if chat_id in translate_ids:
-            translate_ids.remove(chat_id)
-            action = "关闭"
-        else:
-            translate_ids.append(chat_id)
-            action = "开启"
-
-        data["translate_id"] = translate_ids
-
-        with open(file_path, "w", encoding="utf-8") as file:
-            json.dump(data, file, indent=4, ensure_ascii=False)
+        reload_settings_if_changed()
+        enabled = not get_chat_settings(chat_id)["enabled"]
+        update_chat_settings(chat_id, enabled=enabled)
+        action = "开启" if enabled else "关闭"
 
         await message.edit(f"{action} 此ID为 <code>{chat_id}</code> 的群/人翻译成功。")
         await asyncio.sleep(10)
         await message.delete()
+    elif args[0] == "stats":
+        await message.edit(f"{translation_cache.stats()}\n本地预判跳过：{prefilter_skipped} 条")
     else:
-        await message.edit("用法：,fy [无参数] 或 ,fy all on/off 或 ,fy set <目标语言>")
+        await message.edit("用法：,fy [无参数] 或 ,fy all on/off 或 ,fy set <目标语言> 或 ,fy lang [目标语言] 或 ,fy prefix [add/del <前缀>] 或 ,fy batch on/off 或 ,fy api [add/del <地址>] 或 ,fy stats")
         await asyncio.sleep(5)
         await message.delete()
 
-def get_translate_ids():
-    """读取配置文件中的翻译 ID 列表"""
-    file_path = os.path.join(os.getcwd(), "fy.json")
-    try:
-        with open(file_path, "r", encoding="utf-8") as file:
-            data = json.load(file)
-            return data.get("translate_id", [])
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
-
 @listener(is_group=True, outgoing=True, ignore_edited=True)
 async def global_translate(message: Message):
     """全局翻译监听器"""
@@ -101,39 +531,184 @@ async def global_translate(message: Message):
 
     # 检查是否需要翻译
     if not global_translate_enabled:
-        translate_ids = get_translate_ids()
-        if message.chat.id not in translate_ids:
-            return
+        reload_settings_if_changed()
+    settings = get_chat_settings(message.chat.id)
+    if not global_translate_enabled and not settings["enabled"]:
+        return
 
     # 忽略以特定前缀开头的消息
-    prefixes = ["，", ",", "/", "-"]
-    if any(message.text.startswith(prefix) for prefix in prefixes):
+    if message.text.startswith(settings["prefixes"]):
+        return
+
+    # 本地预判已是目标语言或无可翻译内容时跳过
+    if not needs_translation(message.text, settings["lang"] or to_lang):
+        global prefilter_skipped
+        prefilter_skipped += 1
         return
 
+    # 放入聊天队列后立即返回，由后台 worker 翻译并编辑消息
+    enqueue_translation(message)
+
+def enqueue_translation(message):
+    chat_id = message.chat.id
+    queue = _chat_queues.setdefault(chat_id, asyncio.Queue())
+    queue.put_nowait(message)
+    worker = _chat_workers.get(chat_id)
+    if worker is None or worker.done():
+        _chat_workers[chat_id] = asyncio.create_task(chat_worker(chat_id, queue))
+
+async def chat_worker(chat_id, queue):
+    """按顺序处理同一聊天的翻译任务，队列空闲超时后退出"""
+    while True:
+        try:
+            message = await asyncio.wait_for(queue.get(), WORKER_IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            if queue.empty():
+                break
+            continue
+        messages = [message]
+        if batch_translate_enabled:
+            # 在时间窗口内收集同一聊天的后续消息，合并为一次翻译请求
+            deadline = time.monotonic() + BATCH_WINDOW
+            while len(messages) < BATCH_MAX:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    messages.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        try:
+            await translate_and_edit(messages)
+        except Exception as e:
+            print(f"翻译失败：{e}")
+    _chat_workers.pop(chat_id, None)
+    _chat_queues.pop(chat_id, None)
+
+async def translate_and_edit(messages):
     # 调用 DeepLX 翻译
-    translated_text = await translate_deeplx(message.text)
-    if translated_text:
-        new_text = f"<b>{message.text}</b>\n<blockquote><i>{translated_text}</i></blockquote>"
-        await message.edit(new_text)
+    texts = [message.text for message in messages]
+    target_lang = get_chat_settings(messages[0].chat.id)["lang"] or to_lang
+    if len(texts) > 1:
+        results = await translate_batch(texts, target_lang)
+    else:
+        results = [await translate_text(texts[0], target_lang)]
+    for message, translated_text in zip(messages, results):
+        if translated_text:
+            new_text = f"<b>{message.text}</b>\n<blockquote><i>{translated_text}</i></blockquote>"
+            await edit_with_retry(message, new_text)
+
+async def edit_with_retry(message, text):
+    """经令牌桶限速后编辑消息，遇到 FloodWait 按要求的时间等待后重试"""
+    for attempt in range(EDIT_RETRIES + 1):
+        await edit_bucket.acquire()
+        try:
+            return await message.edit(text)
+        except FloodWait as e:
+            if attempt == EDIT_RETRIES:
+                raise
+            await asyncio.sleep(e.value)
 
-async def translate_deeplx(text):
-    """使用 DeepLX API 进行翻译"""
-    url = "https://api.deeplx.org/EaEyeqJu9r6Or7Mpz4ufO2pPYc3MEkqtNN5G2LG1A8k/translate"
+def get_session():
+    """获取共享的 HTTP 会话，复用 keep-alive 连接，避免每条消息都重新进行 TCP/TLS 握手"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_LIMIT, limit_per_host=HTTP_LIMIT_PER_HOST,
+                                         keepalive_timeout=HTTP_KEEPALIVE, ttl_dns_cache=300)
+        _session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+    return _session
+
+@Hook.on_shutdown()
+async def close_session():
+    """PagerMaid 退出时写入未保存的设置并关闭共享会话"""
+    if _save_task and not _save_task.done():
+        _save_task.cancel()
+        save_settings()
+    if _health_task and not _health_task.done():
+        _health_task.cancel()
+    if _session and not _session.closed:
+        await _session.close()
+
+async def translate_deeplx(text, target_lang):
+    """
+    使用 DeepLX API 进行翻译：优先请求延迟最低的可用接口，
+    超过对冲等待时间仍未返回时并行请求下一个接口，取最先成功的结果；失败时依次转移到其余接口。
+    """
     payload = {
         "text": text,
         "source_lang": from_lang,
-        "target_lang": to_lang
+        "target_lang": target_lang
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as response:
-            if response.status != 200:
-                print(f"翻译失败：HTTP {response.status}")
-                return None
+    ensure_health_check()
+    remaining = ranked_backends()
+    pending = set()
+    try:
+        while remaining or pending:
+            if not pending:
+                primary = remaining.pop(0)
+                pending.add(asyncio.create_task(primary.translate(payload)))
+            timeout = None
+            if remaining:
+                timeout = max(HEDGE_MIN, primary.latency * HEDGE_FACTOR) if primary.latency else HEDGE_DEFAULT
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # 首选接口响应过慢，向下一个接口发出对冲请求
+                pending.add(asyncio.create_task(remaining.pop(0).translate(payload)))
+                continue
+            for task in done:
+                if task.result() is not None:
+                    return task.result()
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def translate_text(text, target_lang):
+    """优先从缓存读取译文，未命中时调用翻译接口并写入缓存"""
+    cached = await translation_cache.get(text, from_lang, target_lang)
+    if cached is not None:
+        return cached
+    return await translate_uncached(text, target_lang)
+
+async def translate_uncached(text, target_lang):
+    source_lang = from_lang
+    async with api_semaphore:
+        translated_text = await translate_deeplx(text, target_lang)
+    if translated_text:
+        await translation_cache.set(text, source_lang, target_lang, translated_text)
+    return translated_text
+
+def join_batch(texts):
+    return "".join(text if i == 0 else f"\n{BATCH_MARKER.format(i)}\n{text}" for i, text in enumerate(texts))
+
+def split_batch(translated, count):
+    """按编号标记拆分合并翻译的结果，标记缺失或顺序错乱时返回 None"""
+    parts = BATCH_SPLIT.split(translated)
+    if len(parts) != count * 2 - 1 or [int(i) for i in parts[1::2]] != list(range(1, count)):
+        return None
+    return [part.strip() for part in parts[0::2]]
+
+async def translate_batch(texts, target_lang):
+    """
+    合并翻译多条消息：先查缓存，未命中的消息用编号标记拼接为一次请求，
+    译文无法按标记拆回时退回逐条翻译。返回与 texts 一一对应的译文列表。
+    """
+    results = [await translation_cache.get(text, from_lang, target_lang) for text in texts]
+    pending = [i for i, result in enumerate(results) if result is None]
+    batchable = [i for i in pending if "§§" not in texts[i]]
 
-            result = await response.json()
-            if result.get("code") != 200:
-                print(f"翻译失败：{result}")
-                return None
+    if len(batchable) > 1:
+        source_lang = from_lang
+        async with api_semaphore:
+            translated = await translate_deeplx(join_batch([texts[i] for i in batchable]), target_lang)
+        parts = split_batch(translated, len(batchable)) if translated else None
+        if parts:
+            for i, part in zip(batchable, parts):
+                results[i] = part
+                await translation_cache.set(texts[i], source_lang, target_lang, part)
 
-            return result.get("data")
\ No newline at end of file
+    for i in pending:
+        if results[i] is None:
+            results[i] = await translate_uncached(texts[i], target_lang)
+    return results
@@ -1,18 +1,159 @@
 import datetime
-from collections import defaultdict
+import os
 import json
+import heapq
+import bisect
+import time
+import array
+import asyncio
+import sqlite3
 from pagermaid.listener import listener
 from pagermaid.enums import Client, Message
+from pagermaid.hook import Hook
 from pyrogram.enums import ParseMode
 
+DB_PATH = "data/grptime.db"
+SNAPSHOT_TTL = 7 * 24 * 3600  # 快照超过该时间（秒）后查询时重新全量扫描
+SAVE_DELAY = 30               # 增量更新后延迟写入（秒），合并短时间内的多次变更
+
+
+class MemberSnapshot:
+    """单个群的成员入群时间快照：user_id -> 入群时间戳"""
+
+    def __init__(self, members=None, updated_at=0.0):
+        self.members = members or {}
+        self.updated_at = updated_at
+
+    @classmethod
+    def from_blobs(cls, user_ids, joined, updated_at):
+        ids, dates = array.array("q"), array.array("q")
+        ids.frombytes(user_ids)
+        dates.frombytes(joined)
+        return cls(dict(zip(ids, dates)), updated_at)
+
+    def to_blobs(self):
+        return array.array("q", self.members.keys()).tobytes(), array.array("q", self.members.values()).tobytes()
+
+    def month_counts(self):
+        """按本地时区的月份统计：时间戳排序后按每月起始时间二分计数，不必逐个格式化，也不受时区偏移影响"""
+        timestamps = sorted(self.members.values())
+        counts = {}
+        if not timestamps:
+            return counts
+        month = datetime.datetime.fromtimestamp(timestamps[0]).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        index = 0
+        while index < len(timestamps):
+            if month.month == 12:
+                next_month = month.replace(year=month.year + 1, month=1)
+            else:
+                next_month = month.replace(month=month.month + 1)
+            end = bisect.bisect_left(timestamps, next_month.timestamp())
+            if end > index:
+                counts[month.strftime("%Y-%m")] = end - index
+            index = end
+            month = next_month
+        return counts
+
+    def earliest(self, start, end):
+        """返回按入群时间排序后第 start 到 end 名的 (时间戳, user_id)"""
+        if end < start:
+            return []
+        items = heapq.nsmallest(end, ((timestamp, user_id) for user_id, timestamp in self.members.items()))
+        return items[start - 1:end]
+
+
+class SnapshotStore:
+    """成员快照存储：sqlite 中每个群一行，user_id 和入群时间以 int64 数组紧凑保存，内存中按需加载"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS snapshots "
+                        "(chat_id INTEGER PRIMARY KEY, user_ids BLOB, joined BLOB, updated_at REAL)")
+        self.db.commit()
+        self.chat_ids = {row[0] for row in self.db.execute("SELECT chat_id FROM snapshots")}
+        self.loaded = {}
+        self.dirty = set()
+        self._save_task = None
+
+    def get(self, chat_id):
+        if chat_id not in self.chat_ids:
+            return None
+        snapshot = self.loaded.get(chat_id)
+        if snapshot is None:
+            row = self.db.execute("SELECT user_ids, joined, updated_at FROM snapshots WHERE chat_id = ?",
+                                  (chat_id,)).fetchone()
+            if row is None:
+                self.chat_ids.discard(chat_id)
+                return None
+            snapshot = self.loaded[chat_id] = MemberSnapshot.from_blobs(*row)
+        return snapshot
+
+    def put(self, chat_id, snapshot):
+        self.chat_ids.add(chat_id)
+        self.loaded[chat_id] = snapshot
+        self.dirty.discard(chat_id)
+        self.save(chat_id)
+
+    def save(self, chat_id):
+        snapshot = self.loaded[chat_id]
+        self.db.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)",
+                        (chat_id, *snapshot.to_blobs(), snapshot.updated_at))
+        self.db.commit()
+
+    def mark_dirty(self, chat_id):
+        self.dirty.add(chat_id)
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._delayed_save())
+
+    async def _delayed_save(self):
+        await asyncio.sleep(SAVE_DELAY)
+        self.flush()
+
+    def close(self):
+        """取消待执行的延迟写入，立即写入所有未保存的快照"""
+        if self._save_task and not self._save_task.done():
+            self._save_task.cancel()
+        self.flush()
+
+    def flush(self):
+        while self.dirty:
+            chat_id = self.dirty.pop()
+            try:
+                self.save(chat_id)
+            except sqlite3.Error as e:
+                print(f"保存成员快照失败：{e}")
+
+
+snapshot_store = SnapshotStore(DB_PATH)
+
+
+@Hook.on_shutdown()
+async def save_member_snapshots():
+    """PagerMaid 退出时写入尚未保存的增量更新"""
+    snapshot_store.close()
+
+
+async def scan_members(client: Client, chat_id):
+    """全量扫描群成员，生成新的快照"""
+    members = {}
+    async for member in client.get_chat_members(chat_id):
+        if member.joined_date:
+            members[member.user.id] = int(member.joined_date.timestamp())
+    snapshot = MemberSnapshot(members, time.time())
+    snapshot_store.put(chat_id, snapshot)
+    return snapshot
+
 
 @listener(is_plugin=True, outgoing=True, command="grptime",
           description="查询用户入群时间（仅限群组）",
-          parameters="(可选) @用户名 (可选) 开始 结束")
+          parameters="(可选) @用户名 (可选) 开始 结束 (可选) refresh 重新扫描成员")
 async def join_time(client: Client, message: Message):
     """查询用户入群时间。"""
 
     args = message.arguments.split()
+    refresh = "refresh" in args
+    args = [arg for arg in args if arg != "refresh"]
     start = int(args[0]) if len(args) > 0 and args[0].isdigit() else 1
     end = int(args[1]) if len(args) > 1 and args[1].isdigit() else 5
 
@@ -30,22 +171,21 @@ async def join_time(client: Client, message: Message):
         except Exception as e:
             await message.edit(f"获取入群时间时出错：{e}")
     else:
-        # 统计群成员入群时间分布
-        await message.edit("正在统计群成员入群时间分布...")
-        join_month_counts = defaultdict(int)
-        join_times = []
-
-        async for member in client.get_chat_members(message.chat.id):
-            joined_date = member.joined_date
-            if joined_date:
-                join_month_counts[joined_date.strftime("%Y-%m")] += 1
-                join_times.append((joined_date, member.user))
-
-        # 按加入时间排序
-        join_times.sort(key=lambda x: x[0])
+        # 统计群成员入群时间分布，优先使用本地快照
+        snapshot = None if refresh else snapshot_store.get(message.chat.id)
+        if snapshot is None or time.time() - snapshot.updated_at > SNAPSHOT_TTL:
+            await message.edit("正在统计群成员入群时间分布...")
+            snapshot = await scan_members(client, message.chat.id)
+        join_month_counts = snapshot.month_counts()
 
         # 获取指定范围
-        specified_members = join_times[start-1:end]
+        specified_members = snapshot.earliest(start, end)
+        users = {}
+        if specified_members:
+            try:
+                users = {user.id: user for user in await client.get_users([user_id for _, user_id in specified_members])}
+            except Exception:
+                pass
 
         # 格式化输出
         if join_month_counts:
@@ -57,17 +197,34 @@ async def join_time(client: Client, message: Message):
 
             if specified_members:
                 result += "\n最早进群的成员：\n"
-                for join_date, user in specified_members:
-                    name = (user.first_name or '') + ' ' + (user.last_name or '')
-                    name = name.strip() or str(user.id)
-                    joined_datetime = join_date.strftime('%Y-%m-%d %H:%M:%S')
+                for joined_timestamp, user_id in specified_members:
+                    user = users.get(user_id)
+                    name = ((user.first_name or '') + ' ' + (user.last_name or '')).strip() if user else ''
+                    name = name or str(user_id)
+                    joined_datetime = datetime.datetime.fromtimestamp(joined_timestamp).strftime('%Y-%m-%d %H:%M:%S')
                     result += f"- {name} ({joined_datetime})\n"
 
+            updated = datetime.datetime.fromtimestamp(snapshot.updated_at).strftime('%Y-%m-%d %H:%M')
+            result += f"\n快照扫描于 {updated}，共 {len(snapshot.members)} 人"
             await message.edit(result, parse_mode=ParseMode.MARKDOWN)
         else:
             await message.edit("无法获取群成员入群时间信息。")
         return
 
+@listener(is_plugin=True, outgoing=True, incoming=True, ignore_edited=True)
+async def update_member_snapshot(client: Client, message: Message):
+    """根据入群、退群服务消息增量更新已有的成员快照"""
+    if not (message.new_chat_members or message.left_chat_member):
+        return
+    snapshot = snapshot_store.get(message.chat.id)
+    if snapshot is None:
+        return
+    for user in message.new_chat_members or []:
+        snapshot.members[user.id] = int(message.date.timestamp())
+    if message.left_chat_member:
+        snapshot.members.pop(message.left_chat_member.id, None)
+    snapshot_store.mark_dirty(message.chat.id)
+
 @listener(is_plugin=True, outgoing=True, incoming=True, ignore_edited=True)
 async def query_join_time(client: Client, message: Message):
     """查询用户入群时间。"""
@@ -1,9 +1,18 @@
+import io
+import os
+import re
 import json
+import time
+import shutil
+import hashlib
+import tempfile
+import asyncio
 import logging
 from pagermaid.listener import listener
 from pagermaid.enums import Client, Message
 from pagermaid.utils import pip_install
 from pagermaid.dependence import sqlite
+from collections import OrderedDict
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
@@ -29,7 +38,20 @@ default_config = {
     "rate": "+0%",
     "volume": "+0%"
 }
-output = "data/mtts.mp3"
+TEMP_DIR = "data"
+MEMORY_TEXT_LIMIT = 2000  # 超过该字数的文本合成到独立的临时文件，避免整段音频留在内存
+CHUNK_CHARS = 400         # 长文本按句子切分后每段的最大字数
+CHUNK_CONCURRENCY = 4     # 同时合成的段落数上限
+SENTENCE_END = re.compile(r"(?<=[。！？!?；;\n])|(?<=\.)(?=\s)")
+synthesis_semaphore = asyncio.Semaphore(CHUNK_CONCURRENCY)
+
+# edge-tts 固定输出 24kHz 48kbps MP3，opus 格式由本地 ffmpeg 转为 Telegram 语音原生的 OGG/Opus
+AUDIO_EXTENSIONS = {"mp3": "mp3", "opus": "ogg"}
+OPUS_BITRATE = "24k"      # 语音场景下 24kbps Opus 音质已足够
+ENCODE_CONCURRENCY = 2    # 同时运行的 ffmpeg 进程数上限
+FFMPEG = shutil.which("ffmpeg")
+encode_semaphore = asyncio.Semaphore(ENCODE_CONCURRENCY)
+BENCH_TEXT = "这是一段用于测试语音合成格式的文本。Telegram 语音消息原生使用 OGG Opus 编码，体积更小，播放也更快。"
 
 async def config_check() -> dict:
     if not sqlite.get('edge-tts', {}):
@@ -42,23 +64,409 @@ async def config_set(configset, cmd) -> bool:
     sqlite['edge-tts'] = config
     return True
 
-async def getmodel():
-    headers = {'origin': 'https://azure.microsoft.com'}
-    url = "https://eastus.api.speech.microsoft.com/cognitiveservices/voices/list"
-    try:
+VOICES_URL = "https://eastus.api.speech.microsoft.com/cognitiveservices/voices/list"
+VOICES_CACHE_FILE = "data/mtts_voices.json"
+VOICES_TTL = 24 * 3600  # 语音列表缓存有效期（秒），过期后带 ETag 条件请求重新验证
+
+
+class VoiceCatalog:
+    """语音列表缓存：内存 + 磁盘，setname 校验按 ShortName 索引查找，list 在本地做子串筛选"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.voices = []
+        self.etag = None
+        self.last_modified = None
+        self.fetched_at = 0.0
+        self.by_short_name = {}
+        self._load_disk()
+
+    def _load_disk(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.etag = data.get("etag")
+        self.last_modified = data.get("last_modified")
+        self.fetched_at = data.get("fetched_at", 0.0)
+        self._index(data.get("voices", []))
+
+    def _save_disk(self):
+        data = {"etag": self.etag, "last_modified": self.last_modified,
+                "fetched_at": self.fetched_at, "voices": self.voices}
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"保存语音列表缓存失败: {str(e)}")
+
+    def _index(self, voices):
+        self.voices = voices
+        self.by_short_name = {voice["ShortName"]: voice for voice in voices}
+
+    @property
+    def fresh(self):
+        return bool(self.voices) and time.time() - self.fetched_at < self.ttl
+
+    async def _fetch(self):
+        headers = {'origin': 'https://azure.microsoft.com'}
+        if self.voices and self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.voices and self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
         async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
+            async with session.get(VOICES_URL, headers=headers) as response:
+                if response.status == 304:
+                    self.fetched_at = time.time()
+                    self._save_disk()
+                    return
                 if response.status != 200:
                     logger.error(f"API请求失败，状态码: {response.status}, 响应: {await response.text()}")
                     raise Exception(f"API请求失败，状态码: {response.status}")
-                data = await response.json()
-                return data
-    except Exception as e:
-        logger.error(f"获取语音列表失败: {str(e)}")
+                voices = await response.json()
+                self.etag = response.headers.get("ETag")
+                self.last_modified = response.headers.get("Last-Modified")
+        self.fetched_at = time.time()
+        self._index(voices)
+        self._save_disk()
+
+    async def ensure(self):
+        """缓存过期时重新验证；网络失败但有旧缓存时继续使用旧缓存"""
+        if self.fresh:
+            return
+        try:
+            await self._fetch()
+        except Exception as e:
+            logger.error(f"获取语音列表失败: {str(e)}")
+            if not self.voices:
+                raise
+
+    async def get(self, short_name):
+        await self.ensure()
+        return self.by_short_name.get(short_name)
+
+    async def search(self, tag):
+        await self.ensure()
+        return [voice for voice in self.voices
+                if tag in voice['ShortName'] or tag in voice['LocalName'] or tag in voice['LocaleName']]
+
+
+voice_catalog = VoiceCatalog(VOICES_CACHE_FILE, VOICES_TTL)
+
+AUDIO_CACHE_DIR = "data/mtts_cache"
+AUDIO_CACHE_SIZE = 100 * 1024 * 1024  # 语音缓存磁盘上限（字节），超出后按最近最少使用淘汰
+FILE_ID_MAX = 2000                    # 最多记住多少条已发送语音的 file_id
+
+
+def audio_format(config):
+    """读取配置的输出格式，未安装 ffmpeg 时退回 mp3"""
+    fmt = config.get("format", "mp3")
+    if fmt == "opus" and not FFMPEG:
+        logger.warning("未找到 ffmpeg，语音格式退回 mp3")
+        return "mp3"
+    return fmt
+
+
+def audio_cache_key(text, config, fmt):
+    """mp3 沿用不带后缀的摘要作为键，已有的缓存文件和 file_id 继续有效；其他格式追加 -<格式>"""
+    raw = json.dumps([text, config["short_name"], config["rate"], config["volume"], config.get("style")],
+                     ensure_ascii=False)
+    digest = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    return digest if fmt == "mp3" else f"{digest}-{fmt}"
+
+
+def audio_key_format(key):
+    return key.rpartition("-")[2] if "-" in key else "mp3"
+
+
+class AudioCache:
+    """合成结果的磁盘缓存，按文件访问时间做 LRU，总大小不超过 max_size"""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.entries = OrderedDict()  # key -> 文件大小，按最近使用排序
+        self.total = 0
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            key, ext = os.path.splitext(name)
+            if ext[1:] in AUDIO_EXTENSIONS.values() and os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total += size
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.{AUDIO_EXTENSIONS[audio_key_format(key)]}")
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return path
+
+    def set(self, key, data):
+        tmp_path = f"{self.path(key)}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        if not self.put_file(key, tmp_path):
+            os.remove(tmp_path)
+
+    def put_file(self, key, path):
+        """把已写好的音频文件移入缓存，文件超过缓存上限时不移动并返回 False"""
+        size = os.path.getsize(path)
+        if size > self.max_size:
+            return False
+        if key in self.entries:
+            self.total -= self.entries.pop(key)
+        os.replace(path, self.path(key))
+        self.entries[key] = size
+        self.total += size
+        while self.total > self.max_size:
+            self._remove(next(iter(self.entries)))
+        return True
+
+    def _remove(self, key):
+        self.total -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_SIZE)
+
+
+def get_file_id(key):
+    return sqlite.get('mtts-file-ids', {}).get(key)
+
+
+def set_file_id(key, file_id):
+    file_ids = sqlite.get('mtts-file-ids', {})
+    file_ids.pop(key, None)
+    file_ids[key] = file_id
+    while len(file_ids) > FILE_ID_MAX:
+        file_ids.pop(next(iter(file_ids)))
+    sqlite['mtts-file-ids'] = file_ids
+
+
+def split_text(text, limit=CHUNK_CHARS):
+    """按句子边界把文本切成不超过 limit 字的段落，单句过长时硬切"""
+    chunks = []
+    current = ""
+    for sentence in SENTENCE_END.split(text):
+        while len(sentence) > limit:
+            if current.strip():
+                chunks.append(current)
+            current = ""
+            chunks.append(sentence[:limit])
+            sentence = sentence[limit:]
+        if len(current) + len(sentence) > limit and current.strip():
+            chunks.append(current)
+            current = ""
+        current += sentence
+    if current.strip():
+        chunks.append(current)
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+async def synthesize_chunk(text, config):
+    """流式合成一段文本，返回 MP3 字节"""
+    communicate = edge_tts.Communicate(
+        text=text,
+        voice=config["short_name"],
+        rate=config["rate"],
+        volume=config["volume"]
+    )
+    audio = bytearray()
+    async with synthesis_semaphore:
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                audio += chunk["data"]
+    return bytes(audio)
+
+
+class TranscodeError(Exception):
+    """本地 ffmpeg 转码失败，与合成接口的错误区分开提示"""
+
+
+def synthesis_error_text(error):
+    if isinstance(error, TranscodeError):
+        return "❗️ 语音转码失败，请检查 ffmpeg 是否支持 libopus，或使用 ,mtts setformat mp3"
+    return "无法访问微软API，请稍后重试。"
+
+
+async def run_ffmpeg(source, target, data=None):
+    """用 ffmpeg 子进程把 MP3 转为 OGG/Opus，不阻塞事件循环；source/target 为文件路径或 pipe:0/pipe:1"""
+    async with encode_semaphore:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG, "-hide_banner", "-loglevel", "error", "-y", "-f", "mp3", "-i", source,
+            "-vn", "-c:a", "libopus", "-b:a", OPUS_BITRATE, "-application", "voip", "-f", "ogg", target,
+            stdin=asyncio.subprocess.PIPE if data is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await process.communicate(data)
+    if process.returncode != 0:
+        raise TranscodeError(f"ffmpeg 转码失败: {stderr.decode(errors='ignore').strip()}")
+    return stdout
+
+
+async def encode_audio(data, fmt):
+    """把 edge-tts 输出的 MP3 字节转为目标格式"""
+    if fmt == "mp3":
+        return data
+    return await run_ffmpeg("pipe:0", "pipe:1", data)
+
+
+async def encode_file(path, fmt):
+    """把磁盘上的 MP3 文件转为目标格式，返回新的临时文件路径"""
+    fd, target = tempfile.mkstemp(prefix="mtts-", suffix=f".{AUDIO_EXTENSIONS[fmt]}", dir=TEMP_DIR)
+    os.close(fd)
+    try:
+        await run_ffmpeg(path, target)
+    except BaseException:
+        os.remove(target)
         raise
+    return target
+
+
+def pack_audio(data, fmt):
+    buffer = io.BytesIO(data)
+    buffer.name = f"mtts.{AUDIO_EXTENSIONS[fmt]}"
+    return buffer
+
+
+async def synthesize(text, config, fmt):
+    """
+    分段并行合成语音，MP3 帧按顺序直接拼接后转为目标格式。
+    短文本返回内存缓冲区；长文本的各段按顺序写入独立的临时文件，写入后即释放，返回文件路径。
+    """
+    if len(text) <= MEMORY_TEXT_LIMIT:
+        parts = await asyncio.gather(*(synthesize_chunk(chunk, config) for chunk in split_text(text)))
+        return pack_audio(await encode_audio(b"".join(parts), fmt), fmt)
+
+    fd, path = tempfile.mkstemp(prefix="mtts-", suffix=".mp3", dir=TEMP_DIR)
+    tasks = [asyncio.create_task(synthesize_chunk(chunk, config)) for chunk in split_text(text)]
+    result = None
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for i, task in enumerate(tasks):
+                f.write(await task)
+                tasks[i] = None  # 已写入的段落不再保留在内存
+        result = path if fmt == "mp3" else await encode_file(path, fmt)
+        return result
+    finally:
+        for task in tasks:
+            if task:
+                task.cancel()
+        if result != path:
+            os.remove(path)
+
+
+async def benchmark_formats(msg: Message, text, config):
+    """对比各输出格式的体积、转码和上传耗时，测试发送的语音随即删除"""
+    start = time.perf_counter()
+    mp3 = b"".join(await asyncio.gather(*(synthesize_chunk(chunk, config) for chunk in split_text(text))))
+    synth_time = time.perf_counter() - start
+    lines = [f"合成：{synth_time * 1000:.0f} ms（{len(text)} 字）"]
+    for fmt in AUDIO_EXTENSIONS:
+        if fmt == "opus" and not FFMPEG:
+            lines.append("opus：未找到 ffmpeg，跳过")
+            continue
+        start = time.perf_counter()
+        data = await encode_audio(mp3, fmt)
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        sent = await msg.reply_voice(pack_audio(data, fmt))
+        upload_time = time.perf_counter() - start
+        await sent.delete()
+        lines.append(f"{fmt}：{len(data) / 1024:.1f} KB | 转码 {encode_time * 1000:.0f} ms | "
+                     f"上传 {upload_time * 1000:.0f} ms | 总计 {(synth_time + encode_time + upload_time) * 1000:.0f} ms")
+    await msg.edit("\n".join(lines))
+
+
+async def tts_reply_progressive(msg: Message, key, chunks, config, fmt, reply_to_message_id):
+    """渐进模式：第一段合成完成后立即发送，其余段落合成完成后合并为第二条语音"""
+    tasks = [asyncio.create_task(synthesize_chunk(chunk, config)) for chunk in chunks]
+    try:
+        first = await tasks[0]
+        await msg.reply_voice(pack_audio(await encode_audio(first, fmt), fmt), reply_to_message_id=reply_to_message_id)
+        rest = b"".join(await asyncio.gather(*tasks[1:]))
+        await msg.reply_voice(pack_audio(await encode_audio(rest, fmt), fmt), reply_to_message_id=reply_to_message_id)
+        full = await encode_audio(first + rest, fmt)
+    except Exception as e:
+        for task in tasks:
+            task.cancel()
+        logger.error(f"TTS转换失败: {str(e)}")
+        return await msg.edit(synthesis_error_text(e))
+    try:
+        audio_cache.set(key, full)
+    except OSError as e:
+        logger.warning(f"写入语音缓存失败: {str(e)}")
+    await msg.delete()
+
+
+async def tts_reply(msg: Message, text, reply_to_message_id=None):
+    """依次尝试复用已发送语音的 file_id、磁盘缓存，最后才重新合成"""
+    config = await config_check()
+    fmt = audio_format(config)
+    key = audio_cache_key(text, config, fmt)
+
+    file_id = get_file_id(key)
+    if file_id:
+        try:
+            await msg.reply_voice(file_id, reply_to_message_id=reply_to_message_id)
+            return await msg.delete()
+        except Exception as e:
+            logger.warning(f"复用语音 file_id 失败，重新发送: {str(e)}")
+
+    temp_path = None
+    audio = audio_cache.get(key)
+    if audio is None and config.get("progressive"):
+        chunks = split_text(text)
+        if len(chunks) > 1:
+            return await tts_reply_progressive(msg, key, chunks, config, fmt, reply_to_message_id)
+    if audio is None:
+        try:
+            audio = await synthesize(text, config, fmt)
+        except Exception as e:
+            logger.error(f"TTS转换失败: {str(e)}")
+            return await msg.edit(synthesis_error_text(e))
+        try:
+            if isinstance(audio, str):
+                if audio_cache.put_file(key, audio):
+                    audio = audio_cache.path(key)
+                else:
+                    temp_path = audio
+            else:
+                audio_cache.set(key, audio.getvalue())
+        except OSError as e:
+            logger.warning(f"写入语音缓存失败: {str(e)}")
+            temp_path = audio if isinstance(audio, str) and os.path.exists(audio) else None
+    try:
+        sent = await msg.reply_voice(audio, reply_to_message_id=reply_to_message_id)
+    finally:
+        if temp_path:
+            os.remove(temp_path)
+    if sent and sent.voice:
+        set_file_id(key, sent.voice.file_id)
+    await msg.delete()
+
 
 @listener(command="mtts", description="文本转语音",
-          parameters="[str]\r\nmtts setname [str]\r\nmtts setrate [int]\r\nmtts setvolume [int]\r\nmtts list [str]")
+          parameters="[str]\r\nmtts setname [str]\r\nmtts setrate [int]\r\nmtts setvolume [int]\r\nmtts setprogressive [on/off]\r\nmtts setformat [mp3/opus]\r\nmtts bench [str]\r\nmtts list [str]")
 async def mtts(msg: Message):
     opt = msg.arguments
     replied_msg = msg.reply_to_message
@@ -66,8 +474,7 @@ async def mtts(msg: Message):
         model_name = opt.split(" ")[1]
         # 验证语音名称
         try:
-            voice_model = await getmodel()
-            if not any(model['ShortName'] == model_name for model in voice_model):
+            if await voice_catalog.get(model_name) is None:
                 return await msg.edit(f"❗️ 无效的语音名称: {model_name}")
         except Exception:
             return await msg.edit("无法访问微软API，请稍后重试。")
@@ -87,50 +494,42 @@ async def mtts(msg: Message):
         if not status:
             return await msg.edit("❗️ TTS设置失败")
         await msg.edit(f"成功设置TTS音量为: {volume}")
+    elif opt.startswith("setprogressive "):
+        progressive = opt.split(" ")[1] == "on"
+        status = await config_set(progressive, "progressive")
+        if not status:
+            return await msg.edit("❗️ TTS设置失败")
+        await msg.edit(f"长文本渐进发送已{'开启' if progressive else '关闭'}")
+    elif opt.startswith("setformat "):
+        fmt = opt.split(" ")[1]
+        if fmt not in AUDIO_EXTENSIONS:
+            return await msg.edit("❗️ 格式仅支持 mp3 或 opus")
+        if fmt == "opus" and not FFMPEG:
+            return await msg.edit("❗️ opus 格式需要安装 ffmpeg")
+        status = await config_set(fmt, "format")
+        if not status:
+            return await msg.edit("❗️ TTS设置失败")
+        await msg.edit(f"成功设置TTS输出格式为: {fmt}")
+    elif opt == "bench" or opt.startswith("bench "):
+        await msg.edit("正在测试各输出格式...")
+        try:
+            await benchmark_formats(msg, opt[6:].strip() or BENCH_TEXT, await config_check())
+        except Exception as e:
+            logger.error(f"格式测试失败: {str(e)}")
+            await msg.edit("格式测试失败，请稍后重试。")
     elif opt.startswith("list "):
         tag = opt.split(" ")[1]
         try:
-            voice_model = await getmodel()
+            voice_model = await voice_catalog.search(tag)
         except Exception:
             return await msg.edit("无法访问微软API，请稍后重试。")
         s = "code | local name | Gender | LocaleName\r\n"
         for model in voice_model:
-            if tag in model['ShortName'] or tag in model['LocalName'] or tag in model['LocaleName']:
-                s += f"{model['ShortName']} | {model['LocalName']} | {model['Gender']} | {model['LocaleName']}\r\n"
+            s += f"{model['ShortName']} | {model['LocalName']} | {model['Gender']} | {model['LocaleName']}\r\n"
         await msg.edit(s)
     elif opt and opt != " ":
-        config = await config_check()
-        try:
-            mp3_buffer = edge_tts.Communicate(
-                text=opt,
-                voice=config["short_name"],
-                rate=config["rate"],
-                volume=config["volume"]
-            )
-            await mp3_buffer.save(output)
-        except Exception as e:
-            logger.error(f"TTS转换失败: {str(e)}")
-            return await msg.edit("无法访问微软API，请稍后重试。")
-        if replied_msg is None:
-            await msg.reply_voice(output)
-            await msg.delete()
-        else:
-            await msg.reply_voice(output, reply_to_message_id=replied_msg.id)
-            await msg.delete()
+        await tts_reply(msg, opt, replied_msg.id if replied_msg else None)
     elif replied_msg:
-        config = await config_check()
-        try:
-            mp3_buffer = edge_tts.Communicate(
-                text=replied_msg.text,
-                voice=config["short_name"],
-                rate=config["rate"],
-                volume=config["volume"]
-            )
-            await mp3_buffer.save(output)
-        except Exception as e:
-            logger.error(f"TTS转换失败: {str(e)}")
-            return await msg.edit("无法访问微软API，请稍后重试。")
-        await msg.reply_voice(output, reply_to_message_id=replied_msg.id)
-        await msg.delete()
+        await tts_reply(msg, replied_msg.text, replied_msg.id)
     else:
         await msg.edit("错误，请使用帮助命令查看用法")
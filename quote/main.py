@@ -1,10 +1,18 @@
 import base64
+import copy
+import functools
+import hashlib
 import io
+import json
 import configparser
 import asyncio
 import os
 import imghdr
+import tempfile
+import time
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pagermaid.enums import Message
 from pagermaid.listener import listener
 from pagermaid.services import client as requests
@@ -14,9 +22,11 @@ from uuid import uuid4
 
 try:
     import boto3
+    from botocore.config import Config as BotoConfig
 except ImportError:
     pip_install("boto3")
     import boto3
+    from botocore.config import Config as BotoConfig
 
 try:
     import cv2
@@ -24,6 +34,12 @@ except ImportError:
     pip_install("opencv-python")
     import cv2
 
+try:
+    from PIL import Image, ImageColor, ImageDraw, ImageFont, ImageOps
+except ImportError:
+    pip_install("Pillow")
+    from PIL import Image, ImageColor, ImageDraw, ImageFont, ImageOps
+
 # --- 尝试多个可能的配置文件路径 ---
 possible_paths = [
     'q.config',
@@ -53,6 +69,14 @@ if not found_config_path:
 # API 配置
 TEXT_QUOTE_API_URL = config.get('API', 'quote_api_url', fallback="https://quote.git.llc/generate")
 
+# 渲染方式：remote 远程 API / local 本地 Pillow 渲染 / local-then-remote 本地失败时回退远程
+RENDER_SETTINGS = {
+    "renderer": config.get('API', 'renderer', fallback="remote").strip().lower(),
+    "font_path": config.get('API', 'font_path', fallback="").strip(),
+}
+if RENDER_SETTINGS["renderer"] not in ("remote", "local", "local-then-remote"):
+    RENDER_SETTINGS["renderer"] = "remote"
+
 # S3 配置
 S3_CONFIG = {
     "bucket_name": config.get('S3', 'bucket_name', fallback=""),
@@ -61,6 +85,13 @@ S3_CONFIG = {
     "secret_key": config.get('S3', 'secret_key', fallback=""),
     "endpoint_url": config.get('S3', 'endpoint_url', fallback=""),
     "region": config.get('S3', 'region', fallback="auto"),
+    # 内容寻址模式：按图片内容哈希命名对象，已存在则跳过上传，由定期清理代替每次删除
+    "content_addressed": config.getboolean('S3', 'content_addressed', fallback=False),
+    "content_prefix": config.get('S3', 'content_prefix', fallback="quote/"),
+    "object_ttl": config.getint('S3', 'object_ttl', fallback=604800),
+    "gc_interval": config.getint('S3', 'gc_interval', fallback=3600),
+    # boto3 调用在线程池中执行，连接池大小决定可并行的 S3 请求数
+    "max_pool_connections": config.getint('S3', 'max_pool_connections', fallback=10),
 }
 
 # Quote 默认设置
@@ -71,6 +102,8 @@ QUOTE_SETTINGS = {
     "scale": config.getint('QUOTE', 'scale', fallback=2),
     "emoji_brand": config.get('QUOTE', 'emoji_brand', fallback="apple"),
     "format": config.get('QUOTE', 'format', fallback="webp"),
+    # 并发提取消息（下载头像/媒体、上传S3）的最大数量
+    "concurrency": config.getint('QUOTE', 'concurrency', fallback=5),
 }
 
 # Media 媒体处理设置
@@ -80,33 +113,275 @@ MEDIA_SETTINGS = {
     "supported_formats": [f.strip() for f in
                           config.get('MEDIA', 'supported_formats', fallback="jpg,jpeg,png,webp").split(',')],
     "enable_compression": config.getboolean('MEDIA', 'enable_compression', fallback=True),
+    # 压缩时的输出格式（webp/jpg）和质量；带透明通道的图片始终输出 webp
+    "compress_format": config.get('MEDIA', 'compress_format', fallback="webp").strip().lower(),
+    "compress_quality": config.getint('MEDIA', 'compress_quality', fallback=80),
+    # 解码/编码等 CPU 密集任务使用的工作线程数
+    "workers": config.getint('MEDIA', 'workers', fallback=2),
+    # 不超过该大小（字节）的媒体以 base64 data URL 直接写入 payload，不经过 S3；0 为关闭
+    "inline_threshold": config.getint('MEDIA', 'inline_threshold', fallback=0),
+    # 单次语录生成中下载的媒体最多占用的内存（字节）
+    "memory_budget": config.getint('MEDIA', 'memory_budget', fallback=52428800),
+    # 优先下载不小于 thumb_min_size（像素，长边）的最小缩略图，没有合适的缩略图时才下载原文件；
+    # 动画、视频贴纸和 TGS 贴纸的预览图通常只有 128~320px，没有达到下限时使用最大的一张，避免下载原文件和提取第一帧
+    "prefer_thumbnails": config.getboolean('MEDIA', 'prefer_thumbnails', fallback=True),
+    # thumb_min_size 为 0 时取渲染宽度 width × scale，保证图片不会被放大
+    "thumb_min_size": config.getint('MEDIA', 'thumb_min_size', fallback=0)
+                      or QUOTE_SETTINGS["width"] * QUOTE_SETTINGS["scale"],
+}
+
+CONTENT_TYPES = {
+    "jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png",
+    "webp": "image/webp",
+}
+
+# Cache 缓存设置
+CACHE_SETTINGS = {
+    "avatar_cache_dir": config.get('CACHE', 'avatar_cache_dir', fallback="data/quote/avatars"),
+    "avatar_memory_items": config.getint('CACHE', 'avatar_memory_items', fallback=256),
+    "avatar_disk_size": config.getint('CACHE', 'avatar_disk_size', fallback=52428800),
+    "avatar_ttl": config.getint('CACHE', 'avatar_ttl', fallback=86400),
+    "s3_index_path": config.get('CACHE', 's3_index_path', fallback="data/quote/s3_index.json"),
+    "render_cache_dir": config.get('CACHE', 'render_cache_dir', fallback="data/quote/renders"),
+    "render_memory_items": config.getint('CACHE', 'render_memory_items', fallback=32),
+    "render_disk_size": config.getint('CACHE', 'render_disk_size', fallback=104857600),
+    "render_ttl": config.getint('CACHE', 'render_ttl', fallback=604800),
 }
 
+MEDIA_ERROR_PAUSE = 5  # 媒体处理失败后留给用户查看错误的时间（秒）
+S3_INIT_RETRY = 60     # S3 连接失败后多久内不再重试（秒）
+
 s3_client_instance = None
+s3_init_lock = asyncio.Lock()
+s3_init_failed_at = float("-inf")
+media_executor = ThreadPoolExecutor(max_workers=max(1, MEDIA_SETTINGS["workers"]), thread_name_prefix="quote-media")
+# 媒体压缩前后的累计字节数，用于 ,q stats 展示节省的带宽
+compression_stats = {"images": 0, "bytes_in": 0, "bytes_out": 0}
+# 媒体下载统计：使用缩略图 / 下载原文件的次数及下载字节数
+download_stats = {"thumbnails": 0, "full": 0, "bytes": 0}
+
+
+class DiskLRUCache:
+    """
+    内存 LRU + 磁盘目录的两级缓存，键需可直接作为文件名。
+    磁盘文件的 mtime 记录写入时间（用于 TTL），atime 记录最近访问时间（用于 LRU 淘汰）。
+    """
+
+    def __init__(self, directory: str, memory_items: int, disk_size: int, ttl: int):
+        self.directory = directory
+        self.memory_items = memory_items
+        self.disk_size = disk_size
+        self.ttl = ttl
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # key -> (写入时间, value)
+        self._disk_usage = None
+
+    def get(self, key: str) -> bytes | None:
+        now = time.time()
+        item = self._memory.get(key)
+        if item:
+            if now - item[0] < self.ttl:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            del self._memory[key]
+
+        path = os.path.join(self.directory, key)
+        try:
+            stat = os.stat(path)
+            if now - stat.st_mtime < self.ttl:
+                with open(path, 'rb') as f:
+                    value = f.read()
+                os.utime(path, (now, stat.st_mtime))
+                self._remember(key, stat.st_mtime, value)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+            os.remove(path)
+        except OSError:
+            pass
+
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: bytes):
+        self._remember(key, time.time(), value)
+        path = os.path.join(self.directory, key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = f"{path}.{uuid4().hex}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(value)
+            os.replace(temp_path, path)
+            if self._disk_usage is None:
+                self._disk_usage = self._scan_disk_usage()
+            else:
+                self._disk_usage += len(value)
+            if self._disk_usage > self.disk_size:
+                self._evict_disk()
+        except OSError:
+            pass  # 磁盘缓存失败不影响主流程，内存缓存仍然可用
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0
+        return (f"命中 {self.hits}（磁盘 {self.disk_hits}） / 未命中 {self.misses}，"
+                f"命中率 {hit_rate:.1f}%，内存条目 {len(self._memory)}")
+
+    def _remember(self, key: str, stored_at: float, value: bytes):
+        self._memory[key] = (stored_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _disk_entries(self) -> list:
+        return [entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith(".tmp")]
+
+    def _scan_disk_usage(self) -> int:
+        return sum(entry.stat().st_size for entry in self._disk_entries())
+
+    def _evict_disk(self):
+        now = time.time()
+        entries = sorted(self._disk_entries(), key=lambda e: e.stat().st_atime)
+        usage = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            # 先清理过期文件，再按最近访问时间淘汰直到低于预算
+            if usage <= self.disk_size and now - entry.stat().st_mtime < self.ttl:
+                continue
+            usage -= entry.stat().st_size
+            os.remove(entry.path)
+        self._disk_usage = usage
+
+
+class S3ObjectIndex:
+    """
+    内容寻址模式下已存在于 S3 的对象索引（对象键 -> 最近使用时间），持久化为本地 JSON。
+    命中索引时跳过 HEAD 请求；清理时按最近使用时间判断对象是否过期。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.reused = 0
+        self.uploaded = 0
+        self.bytes_saved = 0
+        self.last_sweep = 0.0
+        self._objects = None
+        self._dirty = False
+
+    def _load(self) -> dict:
+        if self._objects is None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._objects = json.load(f)
+            except (OSError, ValueError):
+                self._objects = {}
+        return self._objects
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._load()
+
+    def touch(self, key: str):
+        self._load()[key] = time.time()
+        self._dirty = True
+
+    async def exists(self, s3_client, bucket: str, key: str) -> bool:
+        """先查本地索引，未命中时用 HEAD 确认对象是否已在存储桶中。"""
+        if key not in self:
+            try:
+                await asyncio.to_thread(s3_client.head_object, Bucket=bucket, Key=key)
+            except Exception:
+                return False
+        self.touch(key)
+        return True
+
+    def expired(self, ttl: int) -> list[str]:
+        now = time.time()
+        return [key for key, used_at in self._load().items() if now - used_at > ttl]
+
+    def is_expired(self, key: str, ttl: int) -> bool:
+        """不在索引中（孤儿对象）或超过 ttl 未使用时返回 True。"""
+        used_at = self._load().get(key)
+        return used_at is None or time.time() - used_at > ttl
+
+    def discard(self, keys: list[str]):
+        objects = self._load()
+        for key in keys:
+            objects.pop(key, None)
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._objects, f)
+            os.replace(temp_path, self.path)
+            self._dirty = False
+        except OSError:
+            pass
+
+    def stats(self) -> str:
+        return (f"复用 {self.reused} 次（节省 {self.bytes_saved / 1024:.1f} KB），"
+                f"上传 {self.uploaded} 次，索引对象 {len(self._load())}")
+
+
+avatar_cache = DiskLRUCache(CACHE_SETTINGS["avatar_cache_dir"], CACHE_SETTINGS["avatar_memory_items"],
+                            CACHE_SETTINGS["avatar_disk_size"], CACHE_SETTINGS["avatar_ttl"])
+# 渲染结果缓存（键为语录数据的规范化哈希）及首次发送后记录的 Telegram file_id
+render_cache = DiskLRUCache(CACHE_SETTINGS["render_cache_dir"], CACHE_SETTINGS["render_memory_items"],
+                            CACHE_SETTINGS["render_disk_size"], CACHE_SETTINGS["render_ttl"])
+quote_file_ids = DiskLRUCache(os.path.join(CACHE_SETTINGS["render_cache_dir"], "file_ids"), 1024,
+                              CACHE_SETTINGS["render_disk_size"], CACHE_SETTINGS["render_ttl"])
+# 正在下载中的头像，同一语录中同一发送者的并发请求共享一次下载
+avatar_downloads: dict[str, asyncio.Task] = {}
+# 后台任务（S3 清理等）的强引用，防止任务在完成前被回收
+background_tasks: set[asyncio.Task] = set()
+s3_object_index = S3ObjectIndex(CACHE_SETTINGS["s3_index_path"])
+# 本次生成中 show_media_error 显示过错误的进度消息 (chat_id, message_id)
+media_errors_shown: set[tuple[int, int]] = set()
 
 
 async def init_s3_client(message_obj: Message):
-    global s3_client_instance
-    if s3_client_instance:
+    """
+    首次需要上传时才初始化 S3 客户端。并发的媒体任务共用一次初始化；
+    连接失败后 S3_INIT_RETRY 秒内不再重试，避免同一语录中的每张图片都等待一次超时。
+    """
+    global s3_client_instance, s3_init_failed_at
+    async with s3_init_lock:
+        if s3_client_instance:
+            return s3_client_instance
+        if time.monotonic() - s3_init_failed_at < S3_INIT_RETRY:
+            return None
+        s3_client_instance = await connect_s3_client(message_obj)
+        if not s3_client_instance:
+            s3_init_failed_at = time.monotonic()
         return s3_client_instance
 
+
+async def connect_s3_client(message_obj: Message):
     if not (S3_CONFIG.get("access_key") and S3_CONFIG.get("secret_key") and S3_CONFIG.get(
             "endpoint_url") and S3_CONFIG.get("bucket_name")):
-        await message_obj.edit("❌ S3配置不完整，无法初始化R2客户端。请检查q.config文件中[S3]部分所有必需项。")
-        await asyncio.sleep(5)
+        await show_media_error(message_obj, "❌ S3配置不完整，无法初始化R2客户端。请检查q.config文件中[S3]部分所有必需项。")
         return None
 
     try:
-        s3_client_instance = boto3.client(
+        # boto3 为同步库，客户端创建和所有请求都放到线程池执行，避免阻塞事件循环
+        client = await asyncio.to_thread(
+            boto3.client,
             's3',
             aws_access_key_id=S3_CONFIG["access_key"],
             aws_secret_access_key=S3_CONFIG["secret_key"],
             endpoint_url=S3_CONFIG["endpoint_url"],
-            region_name=S3_CONFIG["region"]
+            region_name=S3_CONFIG["region"],
+            config=BotoConfig(max_pool_connections=S3_CONFIG["max_pool_connections"])
         )
-        s3_client_instance.list_objects_v2(Bucket=S3_CONFIG["bucket_name"], MaxKeys=1)
+        await asyncio.to_thread(client.list_objects_v2, Bucket=S3_CONFIG["bucket_name"], MaxKeys=1)
         # 成功初始化后不再编辑消息，只在开始时有“开始生成语录...”
-        return s3_client_instance
+        return client
     except Exception as e:
         error_detail = str(e)
         if "SignatureDoesNotMatch" in error_detail:
@@ -118,9 +393,7 @@ async def init_s3_client(message_obj: Message):
         elif "ConnectTimeout" in error_detail or "Failed to connect" in error_detail:
             error_detail = "无法连接到R2端点，请检查网络或endpoint_url"
 
-        await message_obj.edit(f"❌ R2客户端初始化或连接失败: {error_detail}\n请检查q.config文件中的S3配置。")
-        await asyncio.sleep(10)
-        s3_client_instance = None
+        await show_media_error(message_obj, f"❌ R2客户端初始化或连接失败: {error_detail}\n请检查q.config文件中的S3配置。")
         return None
 
 
@@ -142,50 +415,137 @@ def detect_image_format(data_bytes: bytes) -> str:
     return img_type if img_type else 'unknown'
 
 
-async def extract_first_frame(video_data_io: io.BytesIO, message_obj: Message) -> io.BytesIO | None:
+def decode_first_frame(data: bytes) -> bytes:
     """
-    使用 OpenCV 提取视频（GIF, MP4, WebM等）的第一帧。
-    返回一个包含 JPEG 图像数据的 BytesIO 对象。
+    在工作线程中解码动图/视频的第一帧并编码为 JPEG。
+    GIF/WebP 等图片格式直接用 Pillow 从内存解码，视频容器（WebM/MP4）交给 OpenCV。
     """
-    temp_file_path = f"/tmp/{uuid4()}"
-    try:
-        video_data_io.seek(0)
-        with open(temp_file_path, 'wb') as f:
-            f.write(video_data_io.getvalue())
+    if detect_image_format(data[:2048]) in ("gif", "webp", "png", "jpg"):
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                img.seek(0)
+                frame = img.convert("RGB")
+            frame_io = io.BytesIO()
+            frame.save(frame_io, "JPEG", quality=90)
+            return frame_io.getvalue()
+        except Exception:
+            pass  # Pillow 无法解码时交给 OpenCV 处理
 
-        cap = cv2.VideoCapture(temp_file_path)
+    # OpenCV 只能从文件路径读取视频容器，临时文件在工作线程中写入并自动删除
+    with tempfile.NamedTemporaryFile() as temp_file:
+        temp_file.write(data)
+        temp_file.flush()
+        cap = cv2.VideoCapture(temp_file.name)
         if not cap.isOpened():
-            await message_obj.edit("❌ 无法打开视频文件以提取第一帧。")
-            await asyncio.sleep(5)
-            return None
-
+            raise ValueError("无法打开视频文件以提取第一帧。")
         ret, frame = cap.read()
         cap.release()
-        os.remove(temp_file_path)  # 清理临时文件
 
-        if not ret:
-            await message_obj.edit("❌ 无法读取视频的第一帧。")
-            await asyncio.sleep(5)
-            return None
+    if not ret:
+        raise ValueError("无法读取视频的第一帧。")
 
-        # 将帧编码为 JPEG 格式
-        is_success, buffer = cv2.imencode(".jpg", frame)
-        if not is_success:
-            await message_obj.edit("❌ 无法将第一帧编码为 JPEG。")
-            await asyncio.sleep(5)
-            return None
+    # 将帧编码为 JPEG 格式
+    is_success, buffer = cv2.imencode(".jpg", frame)
+    if not is_success:
+        raise ValueError("无法将第一帧编码为 JPEG。")
+    return buffer.tobytes()
 
-        img_io = io.BytesIO(buffer.tobytes())
-        img_io.name = "first_frame.jpg"
-        return img_io
 
+def strip_metadata(img: Image.Image) -> bytes | None:
+    """按原格式重存图片（JPEG 沿用原量化表，PNG 无损），不携带 EXIF 等元数据；其他格式返回 None。"""
+    output = io.BytesIO()
+    if img.format == "JPEG":
+        img.save(output, "JPEG", quality="keep")
+    elif img.format == "PNG":
+        img.save(output, "PNG", optimize=True)
+    else:
+        return None
+    return output.getvalue()
+
+
+def compress_image(data: bytes, format_type: str) -> tuple[bytes, str]:
+    """
+    在工作线程中预处理图片：缩小到渲染宽度（width × scale），按 compress_format/compress_quality 重新编码。
+    结果始终不携带 EXIF 等元数据；重新编码反而更大时改用按原格式去除元数据后的副本。
+    """
+    target_width = QUOTE_SETTINGS["width"] * QUOTE_SETTINGS["scale"]
+    with Image.open(io.BytesIO(data)) as img:
+        img.seek(0)
+        # 输出不再携带 EXIF，带 Orientation 标记的图片需先把像素转正
+        oriented = img.getexif().get(0x0112, 1) not in (0, 1)
+        source = ImageOps.exif_transpose(img) if oriented else img
+        resized = source.width > target_width
+        stripped = None
+        if resized:
+            img = source.resize((target_width, max(1, source.height * target_width // source.width)))
+        elif oriented:
+            img = source
+        else:
+            stripped = strip_metadata(img)
+            img = img.copy()
+
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+    output = io.BytesIO()
+    if has_alpha or MEDIA_SETTINGS["compress_format"] == "webp":
+        img.save(output, "WEBP", quality=MEDIA_SETTINGS["compress_quality"])
+        output_format = "webp"
+    else:
+        img.convert("RGB").save(output, "JPEG", quality=MEDIA_SETTINGS["compress_quality"], optimize=True)
+        output_format = "jpg"
+
+    if stripped is not None and len(stripped) < output.tell():
+        return stripped, format_type
+    return output.getvalue(), output_format
+
+
+async def compress_media(data: bytes, format_type: str) -> tuple[bytes, str]:
+    try:
+        loop = asyncio.get_running_loop()
+        compressed, format_type = await loop.run_in_executor(media_executor, compress_image, data, format_type)
     except Exception as e:
-        await message_obj.edit(f"❌ 提取视频第一帧失败: {str(e)}")
-        await asyncio.sleep(10)
+        # 原图可能带有 EXIF 等元数据，不能直接上传，由调用方按媒体处理失败处理
+        raise ValueError(f"图片预处理失败: {e}") from e
+    compression_stats["images"] += 1
+    compression_stats["bytes_in"] += len(data)
+    compression_stats["bytes_out"] += len(compressed)
+    return compressed, format_type
+
+
+async def show_media_error(message_obj: Message, text: str):
+    """在进度消息上显示媒体处理错误。并发任务可能先后编辑出相同内容（MessageNotModified），编辑失败时忽略。"""
+    media_errors_shown.add((message_obj.chat.id, message_obj.id))
+    try:
+        await message_obj.edit(text)
+    except Exception:
+        pass
+
+
+async def pause_after_media_error(message_obj: Message):
+    """进度消息上显示过媒体错误时留出查看时间；在所有媒体任务结束后调用，不占用并发名额。"""
+    key = (message_obj.chat.id, message_obj.id)
+    if key in media_errors_shown:
+        media_errors_shown.discard(key)
+        await asyncio.sleep(MEDIA_ERROR_PAUSE)
+
+
+async def extract_first_frame(video_data_io: io.BytesIO, message_obj: Message) -> io.BytesIO | None:
+    """
+    提取视频（GIF, MP4, WebM等）的第一帧，解码在 media_executor 中执行，不阻塞事件循环。
+    返回一个包含 JPEG 图像数据的 BytesIO 对象。
+    """
+    try:
+        loop = asyncio.get_running_loop()
+        frame_bytes = await loop.run_in_executor(media_executor, decode_first_frame, video_data_io.getvalue())
+    except ValueError as e:
+        await show_media_error(message_obj, f"❌ {str(e)}")
         return None
-    finally:
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+    except Exception as e:
+        await show_media_error(message_obj, f"❌ 提取视频第一帧失败: {str(e)}")
+        return None
+
+    img_io = io.BytesIO(frame_bytes)
+    img_io.name = "first_frame.jpg"
+    return img_io
 
 
 async def upload_to_s3(media_data: io.BytesIO, media_type: str, format_type: str, message_obj: Message) -> tuple[
@@ -193,8 +553,7 @@ async def upload_to_s3(media_data: io.BytesIO, media_type: str, format_type: str
                                                                                                            tuple[
                                                                                                                None, None]:
     if not s3_client_instance:
-        await message_obj.edit("❌ S3客户端未就绪，无法上传文件。")
-        await asyncio.sleep(5)
+        await show_media_error(message_obj, "❌ S3客户端未就绪，无法上传文件。")
         return None, None
 
     if isinstance(media_data, io.BytesIO):
@@ -203,67 +562,148 @@ async def upload_to_s3(media_data: io.BytesIO, media_type: str, format_type: str
     elif isinstance(media_data, bytes):
         file_content = media_data
     else:
-        await message_obj.edit(f"❌ 不支持的媒体数据类型: {type(media_data)}")
-        await asyncio.sleep(5)
+        await show_media_error(message_obj, f"❌ 不支持的媒体数据类型: {type(media_data)}")
         return None, None
 
-    # 对于通过 extract_first_frame 提取的图像，统一上传为 jpg
-    if media_type == "extracted_frame":
-        object_name = f"frame_{uuid4()}.jpg"
-        mime_type_header = "image/jpeg"
-    else:
-        object_name = f"{media_type}_{uuid4()}.{format_type}"
-        content_type_map = {
-            "jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png",
-            "webp": "image/webp",
-        }
-        mime_type_header = content_type_map.get(format_type.lower(), "application/octet-stream")
+    # 通过 extract_first_frame 提取的图像以 frame_ 为前缀
+    object_prefix = "frame" if media_type == "extracted_frame" else media_type
+    object_name = f"{object_prefix}_{uuid4()}.{format_type}"
+    mime_type_header = CONTENT_TYPES.get(format_type.lower(), "application/octet-stream")
+
+    if S3_CONFIG["content_addressed"]:
+        digest = hashlib.sha256(file_content).hexdigest()
+        object_name = f"{S3_CONFIG['content_prefix']}{digest}.{format_type}"
+        if await s3_object_index.exists(s3_client_instance, S3_CONFIG["bucket_name"], object_name):
+            s3_object_index.reused += 1
+            s3_object_index.bytes_saved += len(file_content)
+            return f"{S3_CONFIG['public_url']}/{object_name}", object_name
 
     try:
-        s3_client_instance.put_object(
+        await asyncio.to_thread(
+            s3_client_instance.put_object,
             Bucket=S3_CONFIG["bucket_name"],
             Key=object_name,
             Body=file_content,
             ContentType=mime_type_header
         )
+        if S3_CONFIG["content_addressed"]:
+            s3_object_index.touch(object_name)
+            s3_object_index.uploaded += 1
         public_file_url = f"{S3_CONFIG['public_url']}/{object_name}"
         return public_file_url, object_name
     except Exception as e:
         error_detail = str(e)
         if "Access Denied" in error_detail:
             error_detail = "R2存储桶权限不足 (Access Denied)"
-        await message_obj.edit(f"❌ 上传文件 '{object_name[:8]}...' 到R2失败: {error_detail}\n请检查R2权限。")
-        await asyncio.sleep(10)
+        await show_media_error(message_obj, f"❌ 上传文件 '{object_name[:8]}...' 到R2失败: {error_detail}\n请检查R2权限。")
         return None, None
 
 
-async def delete_s3_file(s3_key: str):
-    if not s3_client_instance:
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def delete_s3_files(s3_keys: list[str]) -> bool:
+    """使用 delete_objects 批量删除（每批最多 1000 个），多个批次并行执行。"""
+    if not s3_client_instance or not s3_keys:
         # 无法输出到用户，静默失败
         return False
 
+    batches = [s3_keys[i:i + 1000] for i in range(0, len(s3_keys), 1000)]
     try:
-        s3_client_instance.delete_object(
-            Bucket=S3_CONFIG["bucket_name"],
-            Key=s3_key
-        )
+        await asyncio.gather(*(
+            asyncio.to_thread(
+                s3_client_instance.delete_objects,
+                Bucket=S3_CONFIG["bucket_name"],
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+            )
+            for batch in batches
+        ))
         return True
 
     except Exception:  # 清理失败不向用户报告，不阻塞主流程
         return False
 
 
-async def get_message(client, chat_id, msg_id, message_obj: Message):
+async def download_avatar(client, photo) -> str | None:
+    try:
+        avatar = await client.download_media(photo.big_file_id, in_memory=True)
+    except Exception:
+        # 静默失败，避免因头像下载失败导致整个插件崩溃
+        return None
+    avatar_base64 = base64.b64encode(avatar.getvalue()).decode()
+    avatar_cache.set(photo.big_photo_unique_id, avatar_base64.encode())
+    return avatar_base64
+
+
+async def get_avatar_base64(client, photo) -> str | None:
+    """按头像的 big_photo_unique_id 读取缓存，未命中时下载并写入缓存。"""
+    key = photo.big_photo_unique_id
+    cached = avatar_cache.get(key)
+    if cached is not None:
+        return cached.decode()
+
+    task = avatar_downloads.get(key)
+    if not task:
+        task = asyncio.create_task(download_avatar(client, photo))
+        avatar_downloads[key] = task
+        task.add_done_callback(lambda _: avatar_downloads.pop(key, None))
+    return await task
+
+
+async def sweep_s3_objects(force: bool = False) -> int:
+    """
+    内容寻址模式下的定期清理：删除超过 object_ttl 未使用的对象，
+    以及存储桶前缀下不在索引中且已过期的孤儿对象（content_prefix 为空时不清理孤儿对象）。返回删除的对象数量。
+    """
+    now = time.time()
+    if not s3_client_instance or (not force and now - s3_object_index.last_sweep < S3_CONFIG["gc_interval"]):
+        return 0
+    s3_object_index.last_sweep = now
+    ttl = S3_CONFIG["object_ttl"]
+    bucket = S3_CONFIG["bucket_name"]
+
+    def list_orphans() -> list[str]:
+        paginator = s3_client_instance.get_paginator('list_objects_v2')
+        return [obj["Key"]
+                for page in paginator.paginate(Bucket=bucket, Prefix=S3_CONFIG["content_prefix"])
+                for obj in page.get("Contents", [])
+                if obj["Key"] not in s3_object_index and now - obj["LastModified"].timestamp() > ttl]
+
+    expired_keys = s3_object_index.expired(ttl)
+    # 前缀为空时孤儿对象会涵盖整个存储桶，只清理索引中记录的对象
+    if S3_CONFIG["content_prefix"].strip("/"):
+        try:
+            expired_keys += await asyncio.to_thread(list_orphans)
+        except Exception:  # 清理失败不向用户报告，下次清理时重试
+            return 0
+    # 列举期间并发的语录可能复用了其中的对象，删除前重新确认
+    expired_keys = [key for key in expired_keys if s3_object_index.is_expired(key, ttl)]
+    if expired_keys and not await delete_s3_files(expired_keys):
+        return 0
+
+    s3_object_index.discard(expired_keys)
+    s3_object_index.save()
+    return len(expired_keys)
+
+
+async def get_messages(client, chat_id, msg_ids: list[int], message_obj: Message) -> list:
+    """一次请求批量获取多条消息，按 msg_ids 顺序返回，跳过不存在的消息。"""
     try:
-        return await client.get_messages(chat_id, msg_id)
+        msgs = await client.get_messages(chat_id, msg_ids)
     except Exception as e:
         await message_obj.edit(f"❌ 获取消息失败: {str(e)}\n请检查消息ID或权限。")
         await asyncio.sleep(5)
-        return None
+        return []
+    if not isinstance(msgs, list):
+        msgs = [msgs]
+    return [m for m in msgs if m and not getattr(m, "empty", False)]
 
 
-async def extract_message(msg, client=None, message_obj: Message = None):
-    # --- 用户身份判断逻辑 ---
+def get_sender(msg) -> tuple:
+    """判断消息的显示身份，返回 (user, name, user_id, is_hidden_forward)。"""
     user = None
     name = None
     user_id = None
@@ -273,7 +713,8 @@ async def extract_message(msg, client=None, message_obj: Message = None):
     if msg.forward_sender_name:
         is_hidden_forward = True
         name = msg.forward_sender_name
-        user_id = hash(name)  # 使用名字的哈希作为唯一标识
+        # 使用名字的稳定摘要作为唯一标识（内置 hash 每个进程加盐不同，会使渲染缓存重启后失效）
+        user_id = int(hashlib.sha256(name.encode("utf-8")).hexdigest()[:15], 16)
     # 优先级 2: 转发自公开身份的用户
     elif msg.forward_from:
         user = msg.forward_from
@@ -293,34 +734,45 @@ async def extract_message(msg, client=None, message_obj: Message = None):
             name = getattr(user, "title", None) or " ".join(
                 filter(None, [getattr(user, "first_name", None), getattr(user, "last_name", None)])) or "未知"
 
+    return user, name, user_id, is_hidden_forward
+
+
+def get_media_item(msg):
+    """返回消息中需要作为图片渲染的媒体对象，没有则返回 None。"""
+    if msg.photo or msg.sticker or msg.animation:
+        return msg.photo or msg.sticker or msg.animation
+    if msg.document and (getattr(msg.document, 'mime_type', None) or '').startswith('image/'):
+        return msg.document
+    return None
+
+
+def describe_message(msg) -> dict | None:
+    """
+    只根据消息元数据构建语录数据，不进行任何下载或上传。
+    头像和媒体先以 Telegram 的 unique id 占位，由 resolve_message_media 替换为实际内容；
+    占位状态下的数据同时用作渲染缓存的键。
+    """
+    user, name, user_id, is_hidden_forward = get_sender(msg)
     if not name:
         return None  # 如果最终无法确定发送者姓名，则跳过
 
-    avatar_base64 = None
-    # 隐藏身份的转发、已删除账户或没有头像的用户，不处理头像
-    if user and not is_hidden_forward and not getattr(user, "is_deleted", False) and getattr(user, "photo", None):
-        try:
-            avatar = await client.download_media(user.photo.big_file_id, in_memory=True)
-            avatar_base64 = base64.b64encode(avatar.getvalue()).decode()
-        except Exception:
-            # 静默失败，避免因头像下载失败导致整个插件崩溃
-            pass
-
     text = msg.text or msg.caption or ""
-    has_content = (text or msg.photo or msg.sticker or
-                   (msg.document and getattr(msg.document, 'mime_type', '').startswith('image/')) or
-                   msg.animation)
-
-    if not has_content:
+    media_item = get_media_item(msg)
+    if not (text or media_item):
         return None
 
+    photo = {"base64": None}
+    # 隐藏身份的转发、已删除账户或没有头像的用户，不处理头像
+    if user and not is_hidden_forward and not getattr(user, "is_deleted", False) and getattr(user, "photo", None):
+        photo = {"unique_id": user.photo.big_photo_unique_id}
+
     data = {
         "from": {
             "id": user_id,
             "name": name,
             "username": getattr(user, "username", "") if user else "",
             "emoji_status": str(getattr(getattr(user, "emoji_status", None), "custom_emoji_id", "")) if user else None,
-            "photo": {"base64": avatar_base64} if avatar_base64 else {"base64": None},
+            "photo": photo,
         },
         # --- 核心修正 ---
         # 始终设为 True，让API去决定是显示真头像还是占位符。
@@ -341,67 +793,549 @@ async def extract_message(msg, client=None, message_obj: Message = None):
             for e in msg.entities
         ]
 
-    if client and (msg.photo or msg.sticker or msg.animation or (
-            msg.document and getattr(msg.document, 'mime_type', '').startswith('image/'))):
+    if media_item:
+        data["media"] = {"unique_id": media_item.file_unique_id, "type": "image"}
+
+    return data
+
+
+class MemoryBudget:
+    """单次语录生成中媒体下载可占用的内存预算，下载前按元数据中的文件大小预留。"""
+
+    def __init__(self, limit: int):
+        self.remaining = limit
+
+    def reserve(self, size: int) -> bool:
+        if size > self.remaining:
+            return False
+        self.remaining -= size
+        return True
+
+    def release(self, size: int):
+        self.remaining += size
+
+
+def pick_thumbnail(media_item, allow_smaller: bool):
+    """
+    选择长边不小于 thumb_min_size 的最小缩略图，没有则返回 None。
+    allow_smaller 为 True（原文件需要提取第一帧或无法解码）时，达不到下限则退回最大的一张缩略图。
+    """
+    thumbs = [thumb for thumb in (getattr(media_item, "thumbs", None) or []) if thumb.width and thumb.height]
+    large_enough = [thumb for thumb in thumbs
+                    if max(thumb.width, thumb.height) >= MEDIA_SETTINGS["thumb_min_size"]]
+    if large_enough:
+        return min(large_enough, key=lambda thumb: thumb.width * thumb.height)
+    if not allow_smaller:
+        return None
+    return max(thumbs, key=lambda thumb: thumb.width * thumb.height, default=None)
+
+
+async def download_media_bounded(client, media_item, limit: int) -> bytes | None:
+    """流式下载媒体到内存，超过 limit 字节时立即中止并返回 None。"""
+    buffer = bytearray()
+    async for chunk in client.stream_media(media_item):
+        buffer += chunk
+        if len(buffer) > limit:
+            return None
+    return bytes(buffer)
+
+
+async def resolve_message_media(data: dict, msg, client, message_obj: Message, budget: MemoryBudget) -> bool:
+    """
+    下载头像、处理并上传媒体，将 describe_message 的占位内容替换为 API 可用的数据。
+    是否下载由消息元数据（文件大小、动态贴纸类型）预先判断，下载受内存预算限制。
+    返回 False 表示出现了临时性失败（头像获取、下载或处理出错、内存预算不足），此时结果不写入渲染缓存；
+    不支持的格式、文件过大等由媒体本身决定的占位结果每次都相同，仍返回 True 以便缓存。
+    """
+    ok = True
+
+    if "unique_id" in data["from"]["photo"]:
+        user = get_sender(msg)[0]
+        avatar_base64 = await get_avatar_base64(client, user.photo)
+        data["from"]["photo"] = {"base64": avatar_base64}
+        ok = avatar_base64 is not None
+
+    if not data.get("media"):
+        return ok
+
+    del data["media"]
+    media_item = get_media_item(msg)
+    # TGS 动态贴纸是 Lottie 矢量动画，无法作为图片处理，只能使用缩略图，没有缩略图时不下载
+    is_tgs = getattr(media_item, "is_animated", False)
+    # 动画和视频贴纸的原文件需要提取第一帧，较小的预览图也比下载原文件划算；图片文件和静态贴纸则不放大预览图
+    needs_frame = bool(msg.animation) or getattr(media_item, "is_video", False)
+    thumb = (pick_thumbnail(media_item, allow_smaller=is_tgs or needs_frame)
+             if MEDIA_SETTINGS["prefer_thumbnails"] or is_tgs else None)
+    if not thumb and is_tgs:
+        data["text"] = "*不支持的媒体格式: tgs*"
+        return ok
+
+    download_item = thumb or media_item
+    file_size = getattr(download_item, "file_size", None) or 0
+    if file_size > MEDIA_SETTINGS["max_file_size"]:
+        await show_media_error(message_obj, f"❌ 媒体文件过大: {file_size} > {MEDIA_SETTINGS['max_file_size']} 字节")
+        data["text"] = "*媒体文件过大*"
+        return ok
+
+    # 元数据中没有文件大小时按上限预留
+    reserved = file_size or MEDIA_SETTINGS["max_file_size"]
+    if not budget.reserve(reserved):
+        data["text"] = "*超出媒体内存预算*"
+        return False
+
+    kept = False
+    try:
+        media_bytes = await download_media_bounded(client, download_item.file_id, MEDIA_SETTINGS["max_file_size"])
+        if media_bytes is None:
+            await show_media_error(message_obj, f"❌ 媒体文件过大: > {MEDIA_SETTINGS['max_file_size']} 字节")
+            data["text"] = "*媒体文件过大*"
+            return ok
+        budget.release(reserved - len(media_bytes))
+        reserved = len(media_bytes)
+        download_stats["thumbnails" if thumb else "full"] += 1
+        download_stats["bytes"] += len(media_bytes)
+        downloaded_media_io = io.BytesIO(media_bytes)
+
+        media_bytes_peek = downloaded_media_io.getvalue()[:2048]
+        detected_format = detect_image_format(media_bytes_peek)
+
+        processed_media_io = downloaded_media_io
+        upload_media_type = "media"
+        format_type = detected_format
+
+        # 如果是动画（GIF, WebM, 视频贴纸等）且没有可用的缩略图，提取第一帧
+        if not thumb and (detected_format in ["gif", "webm"] or msg.animation or getattr(media_item, "is_video", False)):
+            first_frame_io = await extract_first_frame(downloaded_media_io, message_obj)
+            if first_frame_io:
+                processed_media_io = first_frame_io
+                format_type = "jpg"
+                upload_media_type = "extracted_frame"
+            else:
+                data["text"] = "*提取第一帧失败*"
+                return False
+
+        if format_type.lower() in MEDIA_SETTINGS['supported_formats'] or upload_media_type == "extracted_frame":
+            media_bytes = processed_media_io.getvalue()
+            if MEDIA_SETTINGS["enable_compression"]:
+                media_bytes, format_type = await compress_media(media_bytes, format_type)
+            # 先保留处理后的字节：本地渲染直接使用，远程渲染前由 stage_message_media 上传
+            data["media"] = {
+                "type": "image",
+                "bytes": media_bytes,
+                "format": format_type,
+                "media_type": upload_media_type,
+            }
+            kept = True
+            return ok
+        data["text"] = f"*不支持的媒体格式: {format_type}*"
+        return ok
+
+    except Exception as e:
+        await show_media_error(message_obj, f"❌ 媒体文件处理失败: {str(e)}")
+        data["text"] = f"*媒体文件处理失败*"
+    finally:
+        # 媒体未被保留（下载中止、格式不支持或处理失败）时归还预留的内存
+        if not kept:
+            budget.release(reserved)
+
+    return False
+
+
+async def stage_message_media(data: dict, message_obj: Message) -> bool:
+    """
+    把处理后的媒体字节转换为远程 API 可访问的 URL：
+    不超过 inline_threshold 的内联为 base64 data URL，更大的上传到 S3。
+    """
+    media = data.get("media")
+    if not media or "bytes" not in media:
+        return True
+
+    media_bytes, format_type = media["bytes"], media["format"]
+    # 小图直接内联为 data URL，省去上传、API 侧下载和后续删除
+    if len(media_bytes) <= MEDIA_SETTINGS["inline_threshold"]:
+        mime_type = CONTENT_TYPES.get(format_type.lower(), "application/octet-stream")
+        data["media"] = {
+            "url": f"data:{mime_type};base64,{base64.b64encode(media_bytes).decode()}",
+            "type": "image",
+        }
+        return True
+
+    del data["media"]
+    if not (S3_CONFIG.get("bucket_name") and S3_CONFIG.get("access_key")):
+        data["text"] = "*S3未配置*"
+        return False
+    # 只有确实需要上传时才初始化 S3，纯文本或全部内联的语录无需 S3 配置
+    if not await init_s3_client(message_obj):
+        data["text"] = "*S3连接失败*"
+        return False
+    image_url, s3_key_for_cleanup = await upload_to_s3(media_bytes, media["media_type"], format_type, message_obj)
+    if not image_url:
+        data["text"] = "*S3上传失败*"
+        return False
+    data["media"] = {
+        "url": image_url,
+        "type": "image",
+        "s3_key": s3_key_for_cleanup
+    }
+    return True
+
+
+async def resolve_message_pair(msg, data: dict, reply_data: dict | None, client, message_obj: Message,
+                               semaphore: asyncio.Semaphore, budget: MemoryBudget, stage: bool) -> bool:
+    """在并发上限内处理一条消息及其回复消息的头像和媒体，stage 为 True 时同时上传到 S3。"""
+    ok = True
+    for item, item_msg in ((data, msg), (reply_data, msg.reply_to_message)):
+        if not item:
+            continue
+        async with semaphore:
+            ok = await resolve_message_media(item, item_msg, client, message_obj, budget) and ok
+            if stage:
+                ok = await stage_message_media(item, message_obj) and ok
+    return ok
+
+
+def build_payload(described: list, background_color: str) -> dict:
+    """由处理后的消息数据组装渲染 payload，在副本上处理连续发送者的头像折叠，可重复调用。"""
+    all_messages_data = []
+    last_user_id = None
+
+    for m, data, reply_data in described:
+        data, reply_data = copy.deepcopy(data), copy.deepcopy(reply_data)
+        if data.get("media"):
+            data["media"] = payload_media(data["media"])
+
+        current_user_id = data["from"]["id"]
+        # 如果是同一用户连续发送多条消息，后续消息不显示头像和用户名
+        if all_messages_data and current_user_id == last_user_id:
+            data["avatar"] = False
+            data["from"]["name"] = ""
+            data["from"]["username"] = ""
+            data["from"]["photo"] = {"base64": None}
+        else:
+            last_user_id = current_user_id
+
+        if reply_data:
+            reply_name = reply_data["from"].get("name", "未知用户")
+            reply_text = reply_data.get("text", "")
+
+            if not reply_text and (
+                    m.reply_to_message.photo or m.reply_to_message.video or m.reply_to_message.animation or m.reply_to_message.sticker or m.reply_to_message.audio or m.reply_to_message.voice or m.reply_to_message.document):
+                reply_text = "[媒体文件]"
+
+            data["replyMessage"] = {
+                "name": reply_name,
+                "text": reply_text,
+                "entities": reply_data.get("entities", []),
+                "chatId": reply_data["from"]["id"],
+            }
+            if reply_data.get("media"):
+                data["replyMessage"]["media"] = payload_media(reply_data["media"])
+
+        all_messages_data.append(data)
+
+    return {
+        "backgroundColor": background_color,
+        "width": QUOTE_SETTINGS["width"],
+        "height": QUOTE_SETTINGS["height"],
+        "scale": QUOTE_SETTINGS["scale"],
+        "emojiBrand": QUOTE_SETTINGS["emoji_brand"],
+        "messages": all_messages_data,
+        "format": QUOTE_SETTINGS["format"]
+    }
+
+
+def payload_media(media: dict) -> dict:
+    """已上传的媒体以 URL 写入 payload，否则保留字节供本地渲染使用。"""
+    if "url" in media:
+        return {"url": media["url"], "type": media["type"]}
+    return {"bytes": media["bytes"], "type": media["type"]}
+
+
+def collect_s3_keys(described: list) -> list[str]:
+    return [item["media"]["s3_key"]
+            for _, data, reply_data in described
+            for item in (data, reply_data)
+            if item and item.get("media") and item["media"].get("s3_key")]
+
+
+async def render_quote_remote(payload: dict) -> bytes:
+    res = await requests.post(TEXT_QUOTE_API_URL, json=payload)
+    res.raise_for_status()
+    json_data = res.json()
+    if not json_data.get("ok"):
+        error_msg = json_data.get("error", "未知API错误")
+        raise Exception(f"API返回失败: {error_msg}")
+    return base64.b64decode(json_data["result"]["image"])
+
+
+# --- 本地渲染 ---
+# Telegram 风格的用户名颜色，按用户 id 取色
+NAME_COLORS = ["#FF8E86", "#FFA357", "#B18FFF", "#4DD6BF", "#45E8D1", "#7AC9FF", "#FF7FD5"]
+FONT_CANDIDATES = [
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/wenquanyi/wqy-microhei/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+]
+
+
+@functools.lru_cache(maxsize=16)
+def load_font(size: int):
+    paths = ([RENDER_SETTINGS["font_path"]] if RENDER_SETTINGS["font_path"] else []) + FONT_CANDIDATES
+    for font_path in paths:
         try:
-            media_item = msg.photo or msg.sticker or msg.animation or msg.document
-            downloaded_media_io = await client.download_media(media_item, in_memory=True)
-            downloaded_media_io.seek(0)
-
-            file_size = len(downloaded_media_io.getvalue())
-            if file_size > MEDIA_SETTINGS["max_file_size"]:
-                await message_obj.edit(f"❌ 媒体文件过大: {file_size} > {MEDIA_SETTINGS['max_file_size']} 字节")
-                await asyncio.sleep(10)
-                data["text"] = "*媒体文件过大*"
-                return data
-
-            media_bytes_peek = downloaded_media_io.getvalue()[:2048]
-            detected_format = detect_image_format(media_bytes_peek)
-
-            processed_media_io = downloaded_media_io
-            upload_media_type = "media"
-            format_type = detected_format
-
-            # 如果是动画（GIF, WebM等），提取第一帧
-            if detected_format in ["gif", "webm"] or (msg.animation):
-                await message_obj.edit("正在提取媒体第一帧...")
-                first_frame_io = await extract_first_frame(downloaded_media_io, message_obj)
-                if first_frame_io:
-                    processed_media_io = first_frame_io
-                    format_type = "jpg"
-                    upload_media_type = "extracted_frame"
-                    await message_obj.edit("第一帧提取成功，准备上传...")
-                else:
-                    await message_obj.edit("❌ 提取第一帧失败，跳过媒体处理。")
-                    data["text"] = "*提取第一帧失败*"
-                    return data
-
-            if format_type.lower() in MEDIA_SETTINGS['supported_formats'] or upload_media_type == "extracted_frame":
-                if S3_CONFIG.get("bucket_name") and S3_CONFIG.get("access_key"):
-                    image_url, s3_key_for_cleanup = await upload_to_s3(processed_media_io, upload_media_type,
-                                                                       format_type, message_obj)
-                    if image_url:
-                        data["media"] = {
-                            "url": image_url,
-                            "type": "image",
-                            "s3_key": s3_key_for_cleanup
-                        }
-                    else:
-                        data["text"] = "*S3上传失败*"
+            return ImageFont.truetype(font_path, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:  # Pillow < 10.1 的默认字体不支持指定大小
+        return ImageFont.load_default()
+
+
+def parse_color(color: str, fallback: str = "#1b1429") -> tuple:
+    try:
+        return ImageColor.getrgb(color)[:3]
+    except ValueError:
+        return ImageColor.getrgb(fallback)[:3]
+
+
+def wrap_text(text: str, font, max_width: int) -> list[str]:
+    """按像素宽度换行，优先在空格处断开，保留原有换行。"""
+    lines = []
+    for paragraph in text.split("\n"):
+        line = ""
+        for char in paragraph:
+            if line and font.getlength(line + char) > max_width:
+                cut = line.rfind(" ")
+                if cut > 0:
+                    lines.append(line[:cut])
+                    line = line[cut + 1:] + char
                 else:
-                    data["text"] = "*S3未配置*"
+                    lines.append(line)
+                    line = char
             else:
-                data["text"] = f"*不支持的媒体格式: {format_type}*"
+                line += char
+        lines.append(line)
+    return lines
 
-        except Exception as e:
-            await message_obj.edit(f"❌ 媒体文件处理失败: {str(e)}")
-            await asyncio.sleep(10)
-            data["text"] = f"*媒体文件处理失败*"
 
-    return data
+def open_payload_image(media: dict | None) -> Image.Image | None:
+    if not media:
+        return None
+    raw = media.get("bytes") or (base64.b64decode(media["base64"]) if media.get("base64") else None)
+    if not raw:
+        return None
+    with Image.open(io.BytesIO(raw)) as img:
+        img.seek(0)
+        return img.convert("RGBA")
+
+
+def render_avatar(message: dict, size: int) -> Image.Image:
+    """圆形头像；没有头像图片时用按 id 取色的圆形加名字首字代替。"""
+    avatar = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    mask = Image.new("L", (size, size), 0)
+    ImageDraw.Draw(mask).ellipse((0, 0, size - 1, size - 1), fill=255)
+    photo = open_payload_image(message["from"].get("photo"))
+    if photo:
+        avatar.paste(photo.resize((size, size)), (0, 0), mask)
+        return avatar
+
+    sender_id = message["from"].get("id") or 0
+    fill = Image.new("RGBA", (size, size), parse_color(NAME_COLORS[abs(sender_id) % len(NAME_COLORS)]))
+    avatar.paste(fill, (0, 0), mask)
+    initial = (message["from"].get("name") or "?")[:1]
+    font = load_font(size // 2)
+    ImageDraw.Draw(avatar).text((size / 2, size / 2), initial, font=font, fill="white", anchor="mm")
+    return avatar
+
+
+def render_bubble(message: dict, background: tuple, text_color: tuple, max_width: int, scale: int) -> Image.Image:
+    padding = 10 * scale
+    line_gap = 4 * scale
+    content_width = max_width - padding * 2
+    text_font = load_font(16 * scale)
+    name_font = load_font(15 * scale)
+    reply_font = load_font(14 * scale)
+
+    # 先计算每个元素的尺寸，再按统一宽度绘制：(类型, 内容, 宽, 高)
+    elements = []
+    name = message["from"].get("name")
+    if name:
+        name = wrap_text(name, name_font, content_width)[0]
+        elements.append(("name", name, name_font.getlength(name), name_font.size + line_gap))
+
+    reply = message.get("replyMessage")
+    if reply:
+        bar = 3 * scale
+        reply_name = wrap_text(reply.get("name") or "", reply_font, content_width - bar * 3)[0]
+        reply_text = wrap_text((reply.get("text") or "").replace("\n", " "), reply_font, content_width - bar * 3)[0]
+        reply_width = bar * 3 + max(reply_font.getlength(reply_name), reply_font.getlength(reply_text))
+        elements.append(("reply", (reply_name, reply_text, reply.get("chatId") or 0), reply_width,
+                         (reply_font.size + line_gap) * 2 + line_gap))
+
+    image = open_payload_image(message.get("media"))
+    if image:
+        image.thumbnail((content_width, 320 * scale))
+        elements.append(("media", image, image.width, image.height + line_gap))
+
+    text = message.get("text")
+    if text:
+        lines = wrap_text(text, text_font, content_width)
+        elements.append(("text", lines, max(text_font.getlength(line) for line in lines),
+                         len(lines) * (text_font.size + line_gap)))
+
+    bubble_width = int(max([element[2] for element in elements] + [0]) + padding * 2)
+    bubble_height = int(sum(element[3] for element in elements) + padding * 2 - line_gap)
+    bubble = Image.new("RGBA", (bubble_width, bubble_height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(bubble)
+    draw.rounded_rectangle((0, 0, bubble_width - 1, bubble_height - 1), radius=16 * scale, fill=background)
+
+    sender_id = message["from"].get("id") or 0
+    y = padding
+    for kind, value, _, height in elements:
+        if kind == "name":
+            draw.text((padding, y), value, font=name_font,
+                      fill=parse_color(NAME_COLORS[abs(sender_id) % len(NAME_COLORS)]))
+        elif kind == "reply":
+            reply_name, reply_text, reply_id = value
+            reply_color = parse_color(NAME_COLORS[abs(reply_id) % len(NAME_COLORS)])
+            draw.rectangle((padding, y, padding + 3 * scale, y + height - line_gap * 2), fill=reply_color)
+            draw.text((padding + 9 * scale, y), reply_name, font=reply_font, fill=reply_color)
+            draw.text((padding + 9 * scale, y + reply_font.size + line_gap), reply_text, font=reply_font,
+                      fill=text_color)
+        elif kind == "media":
+            bubble.paste(value, (padding, int(y)), value)
+        else:
+            line_y = y
+            for line in value:
+                draw.text((padding, line_y), line, font=text_font, fill=text_color)
+                line_y += text_font.size + line_gap
+        y += height
+    return bubble
+
+
+def render_quote_locally(payload: dict) -> bytes:
+    """
+    使用 Pillow 按与远程 API 相同的 payload 结构渲染语录，在 media_executor 中调用。
+    媒体可以直接以字节（media["bytes"]）传入，无需经过 S3。不支持实体样式和自定义表情。
+    """
+    scale = payload["scale"]
+    margin = 8 * scale
+    gap = 6 * scale
+    avatar_size = 40 * scale
+    background = parse_color(payload["backgroundColor"])
+    # 背景较亮时使用深色文字
+    luminance = (0.299 * background[0] + 0.587 * background[1] + 0.114 * background[2]) / 255
+    text_color = (0, 0, 0) if luminance > 0.6 else (255, 255, 255)
+    bubble_max_width = payload["width"] * scale - margin * 2 - avatar_size - gap
+
+    rows = []
+    for message in payload["messages"]:
+        bubble = render_bubble(message, background, text_color, bubble_max_width, scale)
+        avatar = render_avatar(message, avatar_size) if message.get("avatar") else None
+        rows.append((avatar, bubble))
+
+    width = int(margin * 2 + avatar_size + gap + max(bubble.width for _, bubble in rows))
+    height = int(margin * 2 + sum(max(bubble.height, avatar_size if avatar else 0) for avatar, bubble in rows)
+                 + gap * (len(rows) - 1))
+    canvas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    y = margin
+    for avatar, bubble in rows:
+        row_height = max(bubble.height, avatar_size if avatar else 0)
+        if avatar:
+            # 与 Telegram 一致，头像对齐到消息底部
+            canvas.paste(avatar, (margin, y + row_height - avatar_size), avatar)
+        canvas.paste(bubble, (margin + avatar_size + gap, y), bubble)
+        y += row_height + gap
+
+    canvas.thumbnail((payload["width"] * scale, payload["height"] * scale))
+    output = io.BytesIO()
+    canvas.save(output, "WEBP" if payload["format"] == "webp" else "PNG")
+    return output.getvalue()
+
+
+def render_cache_key(described: list, background_color: str) -> str:
+    """对占位状态的语录数据和渲染参数做规范化哈希，媒体以内容 id 表示而非 S3 URL。"""
+    canonical = {
+        "renderer": RENDER_SETTINGS["renderer"],
+        "backgroundColor": background_color,
+        "width": QUOTE_SETTINGS["width"],
+        "height": QUOTE_SETTINGS["height"],
+        "scale": QUOTE_SETTINGS["scale"],
+        "emojiBrand": QUOTE_SETTINGS["emoji_brand"],
+        "format": QUOTE_SETTINGS["format"],
+        # 影响媒体处理结果（下载哪个尺寸、压缩参数、占位文字）的设置，修改后不再返回旧图
+        "media": {key: MEDIA_SETTINGS[key] for key in (
+            "enable_compression", "compress_format", "compress_quality", "prefer_thumbnails", "thumb_min_size",
+            "max_file_size", "supported_formats")},
+        "messages": [[data, reply_data] for _, data, reply_data in described],
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+async def send_quote(client, chat_id, media):
+    if QUOTE_SETTINGS['format'] == 'webp':
+        return await client.send_animation(chat_id, media)
+    return await client.send_document(chat_id, media)
+
+
+def remember_file_id(cache_key: str, sent_msg):
+    media = sent_msg and (sent_msg.animation or sent_msg.sticker or sent_msg.document)
+    if media:
+        quote_file_ids.set(cache_key, media.file_id.encode())
+
 
+def quote_image_io(img_bytes: bytes) -> io.BytesIO:
+    img_io = io.BytesIO(img_bytes)
+    img_io.name = f"quote.{QUOTE_SETTINGS['format']}"
+    img_io.seek(0)
+    return img_io
 
-@listener(command="q", description="语录生成 支持颜色参数 r启用回复 多条消息生成")
+
+async def send_cached_quote(client, chat_id, cache_key: str) -> bool:
+    """命中渲染缓存时直接发送：优先用首次发送记录的 file_id，失效时回退到缓存的图片。"""
+    file_id = quote_file_ids.get(cache_key)
+    if file_id is not None:
+        try:
+            await send_quote(client, chat_id, file_id.decode())
+            return True
+        except Exception:
+            pass  # file_id 失效时回退到缓存的图片
+
+    img_bytes = render_cache.get(cache_key)
+    if img_bytes is None:
+        return False
+    sent_msg = await send_quote(client, chat_id, quote_image_io(img_bytes))
+    remember_file_id(cache_key, sent_msg)
+    return True
+
+
+def format_stats() -> str:
+    return (f"📊 语录缓存统计\n头像缓存：{avatar_cache.stats()}\nS3 去重：{s3_object_index.stats()}"
+            f"\n渲染缓存：{render_cache.stats()}\nfile_id 复用：{quote_file_ids.stats()}"
+            f"\n媒体下载：缩略图 {download_stats['thumbnails']} 次 / 原文件 {download_stats['full']} 次，"
+            f"共 {download_stats['bytes'] / 1024:.1f} KB"
+            f"\n媒体压缩：{format_compression_stats()}")
+
+
+def format_compression_stats() -> str:
+    bytes_in, bytes_out = compression_stats["bytes_in"], compression_stats["bytes_out"]
+    saved = (1 - bytes_out / bytes_in) * 100 if bytes_in else 0
+    return (f"处理 {compression_stats['images']} 张，{bytes_in / 1024:.1f} KB → {bytes_out / 1024:.1f} KB"
+            f"（节省 {saved:.1f}%）")
+
+
+def format_timings(timings: dict, message_count: int) -> str:
+    lines = [f"⏱ 语录各阶段耗时（{message_count} 条消息）："]
+    lines += [f"{stage}: {seconds * 1000:.0f} ms" for stage, seconds in timings.items()]
+    lines.append(f"总计: {sum(timings.values()) * 1000:.0f} ms")
+    return "\n".join(lines)
+
+
+@listener(command="q", description="语录生成 支持颜色参数 r启用回复 多条消息生成 bench各阶段耗时 stats缓存统计")
 async def quotly_handler(message: Message):
     global config_read_error_message
     if config_read_error_message:
@@ -409,6 +1343,10 @@ async def quotly_handler(message: Message):
         await asyncio.sleep(10)
         return
 
+    if message.parameter and message.parameter[0].lower() == "stats":
+        await message.edit(format_stats())
+        return
+
     client = message._client
     chat_id = message.chat.id
     base_msg = message.reply_to_message
@@ -423,6 +1361,7 @@ async def quotly_handler(message: Message):
     offset = 0
     background_color = QUOTE_SETTINGS["background_color"]
     enable_reply = False
+    benchmark = False
 
     for param in message.parameter:
         p = param.lstrip("-")
@@ -436,112 +1375,106 @@ async def quotly_handler(message: Message):
                 return
         elif param.lower() in ("r", "回复"):
             enable_reply = True
+        elif param.lower() in ("bench", "测速"):
+            benchmark = True
         elif param.startswith("#") or param.isalpha():
             background_color = param
 
+    timings = {}
+    stage_start = time.perf_counter()
+
     base_id = base_msg.id
     ids = [base_id + i for i in (range(offset + 1, 1) if offset < 0 else range(0, offset + 1) if offset > 0 else [0])]
 
-    messages_to_process = []
-    for msg_id in ids:
-        msg = await get_message(client, chat_id, msg_id, process_msg)
-        if msg:
-            messages_to_process.append(msg)
+    messages_to_process = await get_messages(client, chat_id, ids, process_msg)
+    timings["获取消息"] = time.perf_counter() - stage_start
 
     if not messages_to_process:
         await process_msg.edit("❌ 未找到有效消息。")
         return
 
-    global s3_client_instance
-    s3_client_instance = await init_s3_client(process_msg)
-    if not s3_client_instance:
-        return
-
-    all_messages_data = []
-    s3_keys_to_delete = []
-    last_user_id = None
-
+    described = []
     for m in messages_to_process:
-        data = await extract_message(m, client, process_msg)
+        data = describe_message(m)
         if not data:
             continue
+        reply_data = describe_message(m.reply_to_message) if enable_reply and m.reply_to_message else None
+        described.append((m, data, reply_data))
 
-        if data.get("media") and data["media"].get("s3_key"):
-            s3_keys_to_delete.append(data["media"]["s3_key"])
-
-        current_user_id = data["from"]["id"]
-        # 如果是同一用户连续发送多条消息，后续消息不显示头像和用户名
-        if all_messages_data and current_user_id == last_user_id:
-            data["avatar"] = False
-            data["from"]["name"] = ""
-            data["from"]["username"] = ""
-            data["from"]["photo"] = {"base64": None}
-        else:
-            last_user_id = current_user_id
-
-        if enable_reply and m.reply_to_message:
-            reply_data = await extract_message(m.reply_to_message, client, process_msg)
-            if reply_data:
-                if reply_data.get("media") and reply_data["media"].get("s3_key"):
-                    s3_keys_to_delete.append(reply_data["media"]["s3_key"])
-
-                reply_name = reply_data["from"].get("name", "未知用户")
-                reply_text = reply_data.get("text", "")
-
-                if not reply_text and (
-                        m.reply_to_message.photo or m.reply_to_message.video or m.reply_to_message.animation or m.reply_to_message.sticker or m.reply_to_message.audio or m.reply_to_message.voice or m.reply_to_message.document):
-                    reply_text = "[媒体文件]"
-
-                data["replyMessage"] = {
-                    "name": reply_name,
-                    "text": reply_text,
-                    "entities": reply_data.get("entities", []),
-                    "chatId": reply_data["from"]["id"],
-                }
-                if reply_data.get("media"):
-                    data["replyMessage"]["media"] = {
-                        "url": reply_data["media"]["url"],
-                        "type": reply_data["media"]["type"]
-                    }
-
-        all_messages_data.append(data)
-
-    if not all_messages_data:
+    if not described:
         await process_msg.edit("❌ 未找到可生成语录的有效内容。")
         await asyncio.sleep(5)
         return
 
-    payload = {
-        "backgroundColor": background_color,
-        "width": QUOTE_SETTINGS["width"],
-        "height": QUOTE_SETTINGS["height"],
-        "scale": QUOTE_SETTINGS["scale"],
-        "emojiBrand": QUOTE_SETTINGS["emoji_brand"],
-        "messages": all_messages_data,
-        "format": QUOTE_SETTINGS["format"]
-    }
-
+    stage_start = time.perf_counter()
+    cache_key = render_cache_key(described, background_color)
     try:
-        res = await requests.post(TEXT_QUOTE_API_URL, json=payload)
-        res.raise_for_status()
-        json_data = res.json()
-        if not json_data.get("ok"):
-            error_msg = json_data.get("error", "未知API错误")
-            raise Exception(f"API返回失败: {error_msg}")
-        img_bytes = base64.b64decode(json_data["result"]["image"])
-        img_io = io.BytesIO(img_bytes)
-        img_io.name = f"quote.{QUOTE_SETTINGS['format']}"
-        img_io.seek(0)
-
-        if QUOTE_SETTINGS['format'] == 'webp':
-            await client.send_animation(chat_id, img_io)
+        cache_hit = await send_cached_quote(client, chat_id, cache_key)
+    except Exception:
+        cache_hit = False
+    timings["查询缓存"] = time.perf_counter() - stage_start
+    if cache_hit:
+        if benchmark:
+            await process_msg.edit(format_timings(timings, len(messages_to_process)) + "\n（命中渲染缓存）")
         else:
-            await client.send_document(chat_id, img_io)
-        await process_msg.safe_delete()
+            await process_msg.safe_delete()
+        return
 
-        if s3_keys_to_delete:
-            for s3_key in s3_keys_to_delete:
-                await delete_s3_file(s3_key)
+    renderer = RENDER_SETTINGS["renderer"]
+
+    # 并发处理所有消息（及其回复）的头像和媒体，gather 保证结果顺序与消息顺序一致
+    stage_start = time.perf_counter()
+    semaphore = asyncio.Semaphore(max(1, QUOTE_SETTINGS["concurrency"]))
+    budget = MemoryBudget(MEDIA_SETTINGS["memory_budget"])
+    resolved = await asyncio.gather(
+        *(resolve_message_pair(m, data, reply_data, client, process_msg, semaphore, budget, renderer == "remote")
+          for m, data, reply_data in described))
+    cacheable = all(resolved)
+    timings["提取消息"] = time.perf_counter() - stage_start
+    await pause_after_media_error(process_msg)
+
+    try:
+        stage_start = time.perf_counter()
+        img_bytes = None
+        if renderer != "remote":
+            try:
+                loop = asyncio.get_running_loop()
+                img_bytes = await loop.run_in_executor(media_executor, render_quote_locally,
+                                                       build_payload(described, background_color))
+            except Exception:
+                if renderer == "local":
+                    raise
+        if img_bytes is None:
+            if renderer != "remote":
+                # 本地渲染失败，把媒体上传到 S3（或内联）后回退到远程 API
+                staged = await asyncio.gather(*(stage_message_media(item, process_msg)
+                                                for _, data, reply_data in described
+                                                for item in (data, reply_data) if item))
+                cacheable = cacheable and all(staged)
+                await pause_after_media_error(process_msg)
+            img_bytes = await render_quote_remote(build_payload(described, background_color))
+        timings["渲染语录"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        sent_msg = await send_quote(client, chat_id, quote_image_io(img_bytes))
+        if cacheable:
+            render_cache.set(cache_key, img_bytes)
+            remember_file_id(cache_key, sent_msg)
+        timings["发送图片"] = time.perf_counter() - stage_start
+
+        # S3 清理放到后台执行，不阻塞发送后的流程
+        s3_keys_to_delete = collect_s3_keys(described)
+        if S3_CONFIG["content_addressed"]:
+            # 对象按内容复用，不在每次生成后删除，由定期清理回收
+            s3_object_index.save()
+            run_in_background(sweep_s3_objects())
+        elif s3_keys_to_delete:
+            run_in_background(delete_s3_files(s3_keys_to_delete))
+
+        if benchmark:
+            await process_msg.edit(format_timings(timings, len(messages_to_process)))
+        else:
+            await process_msg.safe_delete()
 
     except Exception as e:
         await process_msg.edit(f"❌ 语录生成失败：{str(e)}\n请检查Quote API服务状态或网络。")
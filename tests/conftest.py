@@ -0,0 +1,102 @@
+"""没有安装 PagerMaid / Pyrogram 时为插件用到的模块提供最小替身，使插件可以在测试中直接加载。"""
+import importlib.util
+import os
+import sys
+import types
+
+import pytest
+
+PLUGINS_DIR = os.path.join(os.path.dirname(__file__), os.pardir)
+
+
+class _FloodWait(Exception):
+    def __init__(self, value=0):
+        super().__init__(value)
+        self.value = value
+
+
+class _Hook:
+    @staticmethod
+    def _decorator(*args, **kwargs):
+        return lambda func: func
+
+    on_startup = on_shutdown = _decorator
+
+
+def _listener(*args, **kwargs):
+    return lambda func: func
+
+
+STUBS = {
+    "pagermaid": {},
+    "pagermaid.listener": {"listener": _listener},
+    "pagermaid.enums": {"Message": object},
+    "pagermaid.hook": {"Hook": _Hook},
+    "pagermaid.services": {"client": None},
+    "pagermaid.utils": {"pip_install": lambda *args, **kwargs: None},
+    "pyrogram": {},
+    "pyrogram.enums": {"MessageEntityType": types.SimpleNamespace(CUSTOM_EMOJI="custom_emoji")},
+    "pyrogram.errors": {"FloodWait": _FloodWait},
+}
+
+
+def _install_stubs():
+    for root in ("pagermaid", "pyrogram"):
+        if importlib.util.find_spec(root) is not None:
+            continue
+        for name, attrs in STUBS.items():
+            if name.split(".")[0] != root:
+                continue
+            module = types.ModuleType(name)
+            module.__dict__.update(attrs)
+            if "." not in name:
+                module.__path__ = []
+            sys.modules[name] = module
+            parent, _, child = name.rpartition(".")
+            if parent:
+                setattr(sys.modules[parent], child, module)
+
+
+_install_stubs()
+
+
+def load_plugin(tmp_path_factory, name):
+    """在临时目录中加载插件，插件的配置和缓存文件都写在临时目录下"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp(name))
+    try:
+        spec = importlib.util.spec_from_file_location(f"{name}_main", os.path.join(PLUGINS_DIR, name, "main.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        yield module
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope="module")
+def fy(tmp_path_factory):
+    yield from load_plugin(tmp_path_factory, "fy")
+
+
+@pytest.fixture(scope="module")
+def quote(tmp_path_factory):
+    for dependency in ("boto3", "cv2", "PIL"):
+        pytest.importorskip(dependency)
+    yield from load_plugin(tmp_path_factory, "quote")
+
+
+async def start_stub_server(handler, path="/translate"):
+    """在本机随机端口启动只有一个 POST 路由的 aiohttp 服务，返回 (URL, 关闭服务的协程函数)"""
+    web = pytest.importorskip("aiohttp.web")
+    app = web.Application()
+    app.router.add_post(path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    port = runner.addresses[0][1]
+    return f"http://127.0.0.1:{port}{path}", runner.cleanup
+
+
+@pytest.fixture
+def stub_server():
+    return start_stub_server
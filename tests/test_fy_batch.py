@@ -0,0 +1,65 @@
+"""fy 批量翻译的标记拼接/拆分，以及 translate_batch 对接本地假翻译接口的行为。"""
+import asyncio
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+
+
+def run_with_server(fy, stub_server, translate, coro_factory):
+    """启动本地假 DeepLX 接口，translate(text) 决定返回的译文，返回 (协程结果, 收到的请求文本列表)"""
+    requests = []
+
+    async def handler(request):
+        payload = await request.json()
+        requests.append(payload["text"])
+        return web.json_response({"code": 200, "data": translate(payload["text"])})
+
+    async def main():
+        url, cleanup = await stub_server(handler)
+        fy.set_endpoints([url])
+        try:
+            return await coro_factory()
+        finally:
+            await fy.get_session().close()
+            await cleanup()
+
+    return asyncio.run(main()), requests
+
+
+def test_join_split_round_trip(fy):
+    texts = ["第一条", "第二条\n有两行", "3"]
+    assert fy.split_batch(fy.join_batch(texts), len(texts)) == texts
+
+
+def test_split_tolerates_whitespace_and_digit_mangling(fy):
+    assert fy.split_batch("one §§ 1 §§two\n\n§§２§§ three ", 3) == ["one", "two", "three"]
+
+
+def test_split_rejects_missing_or_reordered_markers(fy):
+    assert fy.split_batch("one two three", 3) is None
+    assert fy.split_batch("one §§2§§ two §§1§§ three", 3) is None
+    assert fy.split_batch("one §§1§§ two", 3) is None
+
+
+def test_translate_batch_uses_one_request(fy, stub_server):
+    texts = ["batch alpha", "batch beta", "batch gamma"]
+    results, requests = run_with_server(fy, stub_server, str.upper, lambda: fy.translate_batch(texts, "zh"))
+    assert results == ["BATCH ALPHA", "BATCH BETA", "BATCH GAMMA"]
+    assert len(requests) == 1
+
+
+def test_translate_batch_falls_back_when_markers_are_lost(fy, stub_server):
+    texts = ["lost alpha", "lost beta"]
+    results, requests = run_with_server(fy, stub_server, lambda text: fy.BATCH_SPLIT.sub(" ", text).upper(),
+                                        lambda: fy.translate_batch(texts, "zh"))
+    assert results == ["LOST ALPHA", "LOST BETA"]
+    assert requests[1:] == texts
+
+
+def test_translate_batch_sends_marker_text_alone(fy, stub_server):
+    texts = ["marker §§1§§ inside", "marker plain", "marker other"]
+    results, requests = run_with_server(fy, stub_server, str.upper, lambda: fy.translate_batch(texts, "zh"))
+    assert results == [text.upper() for text in texts]
+    assert texts[0] in requests
+    assert fy.join_batch(texts[1:]) in requests
@@ -0,0 +1,40 @@
+"""fy 多接口路由：对冲请求胜出后，被取消的慢接口要让出首选位置。"""
+import asyncio
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+
+
+def delayed_handler(delay, answer):
+    async def handler(request):
+        await request.json()
+        await asyncio.sleep(delay)
+        return web.json_response({"code": 200, "data": answer})
+
+    return handler
+
+
+def test_cancelled_primary_loses_first_place(fy, stub_server):
+    async def main():
+        slow_url, slow_cleanup = await stub_server(delayed_handler(1.0, "slow"))
+        fast_url, fast_cleanup = await stub_server(delayed_handler(0.0, "fast"))
+        fy.set_endpoints([slow_url, fast_url])
+        slow, fast = fy.backends
+        slow.latency, fast.latency = 0.002, 0.05
+        try:
+            result = await fy.translate_deeplx("hedge", "zh")
+            await asyncio.sleep(0)
+            return result, slow, fast
+        finally:
+            if fy._health_task:
+                fy._health_task.cancel()
+            await fy.get_session().close()
+            await slow_cleanup()
+            await fast_cleanup()
+
+    result, slow, fast = asyncio.run(main())
+    assert result == "fast"
+    assert slow.latency >= fy.HEDGE_MIN * fy.EWMA_ALPHA
+    assert slow.failures == 0
+    assert fy.ranked_backends()[0] is fast
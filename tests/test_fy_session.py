@@ -0,0 +1,49 @@
+"""fy 共享会话与每次新建会话的对比：对接本地假翻译接口，统计连接数和平均延迟。"""
+import asyncio
+import time
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+web = pytest.importorskip("aiohttp.web")
+
+ROUNDS = 20
+
+
+def test_shared_session_reuses_one_connection(fy, stub_server, record_property):
+    peers = []
+
+    async def handler(request):
+        peers.append(request.transport.get_extra_info("peername"))
+        payload = await request.json()
+        return web.json_response({"code": 200, "data": payload["text"].upper()})
+
+    async def main():
+        url, cleanup = await stub_server(handler)
+        fy.set_endpoints([url])
+        payload = {"text": "hello", "source_lang": "auto", "target_lang": "zh"}
+        try:
+            start = time.perf_counter()
+            for _ in range(ROUNDS):
+                async with aiohttp.ClientSession() as session:
+                    async with session.post(url, json=payload) as response:
+                        await response.read()
+            cold = (time.perf_counter() - start) / ROUNDS
+            cold_peers = set(peers)
+            peers.clear()
+
+            start = time.perf_counter()
+            for _ in range(ROUNDS):
+                assert await fy.translate_deeplx("hello", "zh") == "HELLO"
+            warm = (time.perf_counter() - start) / ROUNDS
+            return cold, warm, cold_peers, set(peers)
+        finally:
+            await fy.get_session().close()
+            await cleanup()
+
+    cold, warm, cold_peers, warm_peers = asyncio.run(main())
+    record_property("cold_session_ms", round(cold * 1000, 2))
+    record_property("shared_session_ms", round(warm * 1000, 2))
+    timings = f"新建会话 {cold * 1000:.2f} ms / 共享会话 {warm * 1000:.2f} ms"
+    assert len(cold_peers) == ROUNDS, timings
+    assert len(warm_peers) == 1, timings
@@ -0,0 +1,126 @@
+"""quote 内容寻址模式下的 S3 对象索引与定期清理，使用 moto 模拟的 S3 存储桶。"""
+import asyncio
+import time
+
+import pytest
+
+moto = pytest.importorskip("moto")
+
+BUCKET = "quote-test"
+PREFIX = "quote/"
+TTL = 3600
+
+
+class ShiftedTime:
+    """只在插件模块内把 time.time() 推后 offset 秒，使 moto 中刚创建的对象在清理时已过期"""
+
+    def __init__(self, offset):
+        self.offset = offset
+
+    def time(self):
+        return time.time() + self.offset
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def s3(quote, monkeypatch, tmp_path):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        import boto3
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        calls = []
+        client.meta.events.register("before-call.s3.*", lambda model, **kwargs: calls.append(model.name))
+        client.calls = calls
+        monkeypatch.setattr(quote, "s3_client_instance", client)
+        monkeypatch.setattr(quote, "s3_object_index", quote.S3ObjectIndex(str(tmp_path / "s3_index.json")))
+        monkeypatch.setitem(quote.S3_CONFIG, "bucket_name", BUCKET)
+        monkeypatch.setitem(quote.S3_CONFIG, "public_url", "https://cdn.example")
+        monkeypatch.setitem(quote.S3_CONFIG, "content_addressed", True)
+        monkeypatch.setitem(quote.S3_CONFIG, "content_prefix", PREFIX)
+        monkeypatch.setitem(quote.S3_CONFIG, "object_ttl", TTL)
+        yield client
+
+
+def bucket_keys(client):
+    return {obj["Key"] for obj in client.list_objects_v2(Bucket=BUCKET).get("Contents", [])}
+
+
+def upload(quote, data):
+    return asyncio.run(quote.upload_to_s3(data, "media", "png", None))
+
+
+def test_index_hit_skips_head_and_put(quote, s3):
+    key = f"{PREFIX}{quote.hashlib.sha256(b'cached').hexdigest()}.png"
+    quote.s3_object_index.touch(key)
+    s3.calls.clear()
+    assert upload(quote, b"cached") == (f"https://cdn.example/{key}", key)
+    assert s3.calls == []
+    assert quote.s3_object_index.reused == 1
+
+
+def test_index_miss_falls_back_to_head(quote, s3):
+    key = f"{PREFIX}{quote.hashlib.sha256(b'existing').hexdigest()}.png"
+    s3.put_object(Bucket=BUCKET, Key=key, Body=b"existing")
+    s3.calls.clear()
+    assert upload(quote, b"existing")[1] == key
+    assert s3.calls == ["HeadObject"]
+    assert key in quote.s3_object_index
+
+    s3.calls.clear()
+    new_key = upload(quote, b"new")[1]
+    assert s3.calls == ["HeadObject", "PutObject"]
+    assert new_key in bucket_keys(s3) and new_key in quote.s3_object_index
+
+
+def test_sweep_deletes_expired_and_orphaned_keys(quote, s3, monkeypatch):
+    expired, fresh, orphan, outside = f"{PREFIX}expired.png", f"{PREFIX}fresh.png", f"{PREFIX}orphan.png", "other.png"
+    for key in (expired, fresh, orphan, outside):
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b"x")
+    monkeypatch.setattr(quote, "time", ShiftedTime(2 * TTL))
+    quote.s3_object_index.touch(fresh)
+    quote.s3_object_index._load()[expired] = time.time()
+
+    assert asyncio.run(quote.sweep_s3_objects(force=True)) == 2
+    assert bucket_keys(s3) == {fresh, outside}
+    assert expired not in quote.s3_object_index and fresh in quote.s3_object_index
+
+
+def test_sweep_keeps_keys_touched_after_listing(quote, s3, monkeypatch):
+    orphan, reused = f"{PREFIX}orphan.png", f"{PREFIX}reused.png"
+    for key in (orphan, reused):
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b"x")
+    monkeypatch.setattr(quote, "time", ShiftedTime(2 * TTL))
+
+    get_paginator = s3.get_paginator
+
+    def paginate_then_touch(name):
+        paginator = get_paginator(name)
+        paginate = paginator.paginate
+
+        def wrapped(**kwargs):
+            yield from paginate(**kwargs)
+            # 模拟列举完成后、删除之前并发的语录复用了该对象
+            quote.s3_object_index.touch(reused)
+
+        paginator.paginate = wrapped
+        return paginator
+
+    monkeypatch.setattr(s3, "get_paginator", paginate_then_touch)
+    assert asyncio.run(quote.sweep_s3_objects(force=True)) == 1
+    assert bucket_keys(s3) == {reused}
+
+
+def test_sweep_skips_orphans_without_prefix(quote, s3, monkeypatch):
+    monkeypatch.setitem(quote.S3_CONFIG, "content_prefix", "")
+    for key in (f"{PREFIX}orphan.png", "other.png"):
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b"x")
+    monkeypatch.setattr(quote, "time", ShiftedTime(2 * TTL))
+    s3.calls.clear()
+
+    assert asyncio.run(quote.sweep_s3_objects(force=True)) == 0
+    assert s3.calls == []
+    assert bucket_keys(s3) == {f"{PREFIX}orphan.png", "other.png"}